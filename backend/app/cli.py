@@ -0,0 +1,221 @@
+# cli.py
+"""
+Offline batch audits of a local folder tree through the same rule engine, dedup and
+Rekognition wrappers (cache + adaptive rate limiting) as pipeline.py.
+
+    python cli.py audit-folder ../../Images --group "Store Front" --out results.jsonl
+    python cli.py audit-folder /data/dump --rule-ids rule_a,rule_b --format parquet --out results.parquet
+    python cli.py migrate-raw-responses   # move legacy images.rekognition_json blobs to image_rekognition_raw
+    python cli.py rebuild-rollups         # recompute the daily compliance rollups from audits
+    python cli.py backfill-phash-chunks   # before switching dedup_backend to "database"
+
+Files are read concurrently (download_workers), decoded and hashed in the image process
+pool (image_workers) and results are appended to one JSONL or Parquet file in batches.
+audit-folder writes nothing to the database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, List
+from config import settings
+from image_utils import init_process_pool, shutdown_process_pool
+from phash_index import PhashIndexRegistry
+from pipeline import RunContext, stream_pipeline
+from rule_engine import get_rules
+from rules_loader import select_rules
+from s3_rek_client import close_clients
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff", ".heic")
+PAGE_SIZE = 1000
+
+# -------------------------
+# Local folder as an object source
+# -------------------------
+def _scan(root: Path, recursive: bool) -> List[os.DirEntry]:
+    entries, dirs = [], [str(root)]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if recursive:
+                        dirs.append(e.path)
+                elif e.name.lower().endswith(IMAGE_EXTENSIONS) and e.is_file():
+                    entries.append(e)
+    return entries
+
+async def iter_local_pages(root: Path, recursive: bool = True) -> AsyncIterator[List[dict]]:
+    """Image files under root as pipeline object pages; Key is the path relative to root."""
+    entries = await asyncio.to_thread(_scan, root, recursive)
+    entries.sort(key=lambda e: e.path)
+    for i in range(0, len(entries), PAGE_SIZE):
+        page = []
+        for e in entries[i:i + PAGE_SIZE]:
+            st = e.stat()
+            page.append({"Key": Path(e.path).relative_to(root).as_posix(), "Size": st.st_size, "ETag": None,
+                         "LastModified": datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)})
+        yield page
+
+def local_reader(root: Path):
+    async def read(key: str) -> bytes:
+        return await asyncio.to_thread((root / key).read_bytes)
+    return read
+
+def _dedup_scope(scope: str):
+    if scope == "dir":
+        return lambda key: key.rsplit("/", 1)[0] + "/" if "/" in key else ""
+    return lambda key: ""  # whole tree
+
+# -------------------------
+# Batched result writers
+# -------------------------
+class JsonlWriter:
+    def __init__(self, path: Path):
+        self._f = open(path, "w", encoding="utf-8")
+
+    def write_batch(self, rows: List[dict]):
+        self._f.write("".join(json.dumps(r, default=str) + "\n" for r in rows))
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+class ParquetWriter:
+    """Flat schema; the per-rule breakdown is kept as a JSON string column."""
+    def __init__(self, path: Path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("--format parquet needs pyarrow (pip install pyarrow)")
+        self._pa = pa
+        self._schema = pa.schema([("path", pa.string()), ("status", pa.string()), ("reason", pa.string()),
+                                  ("rules", pa.string()), ("is_repeated", pa.bool_()),
+                                  ("repeated_of", pa.string()), ("repeat_distance", pa.int32())])
+        self._writer = pq.ParquetWriter(str(path), self._schema)
+
+    def write_batch(self, rows: List[dict]):
+        cols = {name: [r.get(name) for r in rows] for name in self._schema.names}
+        cols["rules"] = [json.dumps(r["rules"]) if r.get("rules") is not None else None for r in rows]
+        self._writer.write_table(self._pa.table(cols, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+def _row(result: dict) -> dict:
+    row = dict(result)
+    return {"path": row.pop("s3_key"), **row}
+
+# -------------------------
+# audit-folder
+# -------------------------
+async def audit_folder(args) -> dict:
+    root = Path(args.folder).resolve()
+    if not root.is_dir():
+        raise SystemExit(f"not a directory: {root}")
+    rules = get_rules().raw
+    try:
+        rule_ids = select_rules(rules, [r for r in (args.rule_ids or "").split(",") if r], args.group, args.section)
+    except KeyError as e:
+        raise SystemExit(f"rule_id {e.args[0]} not found")
+    if not rule_ids:
+        raise SystemExit("no rules selected; pass --rule-ids, --group or --section")
+
+    ctx = RunContext(rule_ids, phash_indexes=PhashIndexRegistry(settings.recent_days, "local", _dedup_scope(args.dedup_scope)),
+                     skip_download=False, read_object=local_reader(root), persist=False)
+    writer = ParquetWriter(Path(args.out)) if args.format == "parquet" else JsonlWriter(Path(args.out))
+    init_process_pool(settings.image_workers)
+    batch: List[dict] = []
+    last_report = time.monotonic()
+    try:
+        async for result in stream_pipeline(iter_local_pages(root, args.recursive), ctx):
+            batch.append(_row(result))
+            if len(batch) >= args.batch_size:
+                writer.write_batch(batch)
+                batch = []
+            if time.monotonic() - last_report >= 5:
+                last_report = time.monotonic()
+                p = ctx.progress()
+                print(f"{p['processed']}/{p['listed']} images, {p['images_per_s']} img/s", file=sys.stderr, flush=True)
+        if batch:
+            writer.write_batch(batch)
+    finally:
+        writer.close()
+        shutdown_process_pool()
+        await close_clients()
+    return {**ctx.progress(), "rule_ids": rule_ids, "out": str(args.out),
+            "rekognition_cache": ctx.cache_stats.as_dict(), "stage_timings": ctx.stage_timings()}
+
+# -------------------------
+# migrate-raw-responses
+# -------------------------
+async def migrate_raw_responses(args) -> dict:
+    from crud import migrate_legacy_rekognition_json
+    from database import create_db_and_tables, engine
+    try:
+        await create_db_and_tables()
+        moved = await migrate_legacy_rekognition_json(args.batch_size)
+    finally:
+        await engine.dispose()
+    return {"moved": moved}
+
+# -------------------------
+# rebuild-rollups
+# -------------------------
+async def rebuild_rollups(args) -> dict:
+    from crud import rebuild_rollups as rebuild
+    from database import create_db_and_tables, engine
+    try:
+        await create_db_and_tables()
+        return await rebuild()
+    finally:
+        await engine.dispose()
+
+# -------------------------
+# backfill-phash-chunks
+# -------------------------
+async def backfill_phash_chunks(args) -> dict:
+    from crud import backfill_phash_chunks as backfill
+    from database import create_db_and_tables, engine
+    try:
+        await create_db_and_tables()
+        return {"filled": await backfill(args.batch_size)}
+    finally:
+        await engine.dispose()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cli.py", description="Visual audit command line tools.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("audit-folder", help="audit every image under a local folder")
+    p.add_argument("folder")
+    p.add_argument("--rule-ids", help="comma-separated rule ids from rules.json")
+    p.add_argument("--group")
+    p.add_argument("--section")
+    p.add_argument("--out", default="audit_results.jsonl")
+    p.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    p.add_argument("--batch-size", type=int, default=500, help="results per write to the output file")
+    p.add_argument("--no-recursive", dest="recursive", action="store_false", help="only the top-level folder")
+    p.add_argument("--dedup-scope", choices=("tree", "dir"), default="tree", help="near-duplicates across the whole tree or per directory")
+    m = sub.add_parser("migrate-raw-responses", help="move legacy images.rekognition_json blobs into image_rekognition_raw")
+    m.add_argument("--batch-size", type=int, default=500, help="images per transaction")
+    sub.add_parser("rebuild-rollups", help="recompute audit_daily_status/audit_daily_reasons from audits (blocks audit writes while it runs)")
+    b = sub.add_parser("backfill-phash-chunks", help="write image_phash_chunks for images that have none (dedup_backend=\"database\")")
+    b.add_argument("--batch-size", type=int, default=1000, help="images per transaction")
+    args = parser.parse_args(argv)
+
+    if args.command == "audit-folder":
+        summary = asyncio.run(audit_folder(args))
+        print(json.dumps(summary, indent=2, default=str))
+    elif args.command == "migrate-raw-responses":
+        print(json.dumps(asyncio.run(migrate_raw_responses(args))))
+    elif args.command == "rebuild-rollups":
+        print(json.dumps(asyncio.run(rebuild_rollups(args))))
+    elif args.command == "backfill-phash-chunks":
+        print(json.dumps(asyncio.run(backfill_phash_chunks(args))))
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,47 @@ class Settings(BaseSettings):
     database_url: str
     phash_hamming_threshold: int = 10
     recent_days: int = 30
-    concurrency: int = 6
+    dedup_backend: str = "memory"  # "memory": per-prefix index loaded per run; "database": chunk-indexed lookup in Postgres (run cli.py backfill-phash-chunks when switching to it)
+    rule_plugins: str = ""         # comma-separated modules registering extra rule types (rule_engine.register_rule_type)
+    concurrency: int = 6            # Rekognition stage workers
+    download_workers: int = 8
+    hash_workers: int = 8           # coroutines feeding the image process pool
+    image_workers: int | None = None  # image process pool size; None = all cores, 0 = threads only
+    rekognition_max_upload_bytes: int = 5 * 1024 * 1024  # larger photos are re-encoded before upload
+    rekognition_max_dimension: int = 1920                # longest side of re-encoded uploads
+    skip_download: bool = False     # default for runs: pHash by ETag + Rekognition S3Object calls
+    queue_size: int = 64            # bound on each inter-stage queue
+    global_concurrency: int = 24    # Rekognition calls in flight across all runs in this process
+    max_running_jobs: int = 4
+    job_progress_interval: float = 5.0
+    work_batch_size: int = 32       # work items a worker.py process claims at a time
+    work_lease_seconds: float = 300.0  # claims not completed or extended within this are retried by other workers
+    work_poll_interval: float = 2.0    # worker sleep when the queue is empty
+    work_max_attempts: int = 3         # claims per item before it is marked FAILED
+    sqs_queue_url: str | None = None     # S3 ObjectCreated notifications consumed by ingest.py
+    sqs_endpoint_url: str | None = None  # SQS-compatible endpoint (ElasticMQ, moto server)
+    sqs_wait_seconds: int = 20           # long-poll wait per receive
+    sqs_visibility_timeout: int = 60     # extended while an object is still being audited
+    sqs_max_in_flight: int = 64          # objects being audited at once by the consumer
+    ingest_routes_path: str = str(Path(__file__).parent / "ingest_routes.json")
+    ingest_context_max_age: float = 3600.0  # seconds before a route's run (and its pHash index) is renewed
+    db_batch_size: int = 500        # records per write-behind flush
+    db_flush_interval: float = 1.0  # seconds between time-based flushes
+    s3_endpoint_url: str | None = None  # S3-compatible endpoint (MinIO, moto server for backend/bench)
+    aws_max_pool_connections: int = 64   # HTTP connections per client (S3, Rekognition)
+    aws_keepalive_timeout: float = 60.0
+    aws_connect_timeout: float = 10.0
+    aws_read_timeout: float = 60.0
+    rek_initial_tps: float = 5.0    # per Rekognition API; adapts between min and max
+    rek_min_tps: float = 0.5
+    rek_max_tps: float = 50.0
+    rek_tps_increase: float = 0.5   # additive increase, TPS per second of successful calls
+    rek_max_retries: int = 6
+    stream_progress_interval: float = 2.0  # seconds between progress events on /run_audit/stream
+    rek_cache_enabled: bool = True
+    rek_cache_path: str = str(Path(__file__).parent / "rekognition_cache.sqlite3")
+    rek_cache_ttl_seconds: int = 30 * 24 * 3600
+    rek_cache_max_mb: int = 512
 
     class Config:
         env_file = str(Path(__file__).parent / ".env")  # points to backend/app/.env
@@ -1,38 +1,605 @@
+import asyncio
+import base64
+import binascii
+import json
+import zlib
+from collections import Counter
+from config import settings
 from database import AsyncSessionLocal
-from models import Image, Audit
-from sqlalchemy import select
-from datetime import datetime, timedelta
-from typing import Dict, Any
-
-async def upsert_image_record(record: Dict[str, Any]):
-    async with AsyncSessionLocal() as session:
-        stmt = await session.execute(select(Image).where(Image.s3_key == record["s3_key"]))
-        existing = stmt.scalar_one_or_none()
-        if existing:
-            for k, v in record.items():
-                if hasattr(existing, k) and v is not None:
-                    setattr(existing, k, v)
-            await session.commit()
-            await session.refresh(existing)
-            return existing
-        else:
-            new = Image(**record)
-            session.add(new)
-            await session.commit()
-            await session.refresh(new)
-            return new
+from models import Image, ImageRekognitionRaw, ImageRule, Audit, AuditDailyStatus, AuditDailyReason, AuditJob, PhashChunk, WorkItem
+from sqlalchemy import select, insert, update, delete, func, cast, literal, text, tuple_, DateTime
+from sqlalchemy.dialects.postgresql import BIT, insert as pg_insert
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
 
-async def insert_audit(audit: Dict[str, Any]):
-    async with AsyncSessionLocal() as session:
-        a = Audit(**audit)
-        session.add(a)
-        await session.commit()
-        await session.refresh(a)
-        return a
+# asyncpg caps a statement at 32767 bind params; keep multi-row VALUES well below that
+_MAX_ROWS_PER_STATEMENT = 1000
+
+PHASH_CHUNKS = 16  # 16-bit chunks of a 256-bit pHash; exact candidate search for distances < 16
 
 async def get_recent_images_phashes(prefix: str, days: int):
+    """
+    Return (s3_key, phash) pairs for images under prefix processed in the last `days` days.
+    phash is the binary phash_bits where present, else the hex string (rows written before it).
+    """
     cutoff = datetime.utcnow() - timedelta(days=days)
     async with AsyncSessionLocal() as session:
-        stmt = select(Image.phash).where(Image.s3_key.like(f"{prefix}%"), Image.processed_at >= cutoff)
+        stmt = select(Image.s3_key, Image.phash_bits, Image.phash).where(Image.s3_key.like(f"{prefix}%"), Image.processed_at >= cutoff, Image.phash.isnot(None))
+        res = await session.execute(stmt)
+        return [(k, bits or p) for k, bits, p in res.all()]
+
+def phash_chunks(phash_hex: str) -> List[int]:
+    """16-bit chunk values of a hex pHash (empty if it isn't a 256-bit hash)."""
+    if not phash_hex or len(phash_hex) != PHASH_CHUNKS * 4:
+        return []
+    return [int(phash_hex[i * 4:i * 4 + 4], 16) for i in range(PHASH_CHUNKS)]
+
+async def find_phash_match(prefix: str, phash_hex: str, radius: int, days: int, exclude_key: str = None) -> Optional[Tuple[str, int]]:
+    """
+    Nearest image under prefix (processed in the last `days` days) within `radius` bits of
+    phash_hex, as (s3_key, distance), or None. Candidates come from indexed equality lookups
+    on image_phash_chunks; the Hamming distance is checked in Postgres, so only the match
+    itself comes back. Exact for radius < PHASH_CHUNKS.
+    """
+    chunks = phash_chunks(phash_hex)
+    if not chunks:
+        return None
+    nbits = len(phash_hex) * 4
+    distance = func.bit_count(cast(literal("x").concat(Image.phash), BIT(nbits)).op("#")(cast(literal("x" + phash_hex), BIT(nbits))))
+    candidates = select(PhashChunk.s3_key).where(tuple_(PhashChunk.chunk_no, PhashChunk.value).in_(list(enumerate(chunks))))
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    stmt = select(Image.s3_key, distance).where(
+        Image.s3_key.in_(candidates), Image.s3_key.like(f"{prefix}%"), Image.processed_at >= cutoff,
+        func.length(Image.phash) == len(phash_hex), distance <= radius,
+    )
+    if exclude_key:
+        stmt = stmt.where(Image.s3_key != exclude_key)
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(stmt.order_by(distance).limit(1))
+        row = res.first()
+        return (row[0], int(row[1])) if row else None
+
+# -------------------------
+# Bulk (batched) persistence
+# -------------------------
+def _to_db_datetime(v):
+    """Columns are naive UTC timestamps; accept ISO strings and aware datetimes too."""
+    if isinstance(v, str):
+        v = datetime.fromisoformat(v)
+    if isinstance(v, datetime) and v.tzinfo is not None:
+        v = v.astimezone(timezone.utc).replace(tzinfo=None)
+    return v
+
+def _normalize_rows(records: List[Dict[str, Any]], model) -> List[Dict[str, Any]]:
+    columns = {c.name: c for c in model.__table__.columns}
+    keys = sorted({k for r in records for k in r if k in columns})
+    rows = []
+    for r in records:
+        row = {}
+        for k in keys:
+            v = r.get(k)
+            if isinstance(columns[k].type, DateTime):
+                v = _to_db_datetime(v)
+            row[k] = v
+        rows.append(row)
+    return rows
+
+def _merge_by_s3_key(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # ON CONFLICT DO UPDATE cannot touch the same row twice in one statement; rows come back
+    # sorted by s3_key so concurrent flushes with overlapping keys lock them in the same order
+    merged: Dict[str, Dict[str, Any]] = {}
+    for r in records:
+        cur = merged.setdefault(r["s3_key"], {})
+        cur.update({k: v for k, v in r.items() if v is not None or k not in cur})
+    return [merged[k] for k in sorted(merged)]
+
+async def _bulk_upsert_images(session, records: List[Dict[str, Any]]):
+    rows = _normalize_rows(_merge_by_s3_key(records), Image)
+    for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+        stmt = pg_insert(Image).values(rows[i:i + _MAX_ROWS_PER_STATEMENT])
+        # None never overwrites an existing value
+        update_cols = {k: func.coalesce(stmt.excluded[k], Image.__table__.c[k]) for k in rows[0] if k not in ("id", "s3_key")}
+        stmt = stmt.on_conflict_do_update(index_elements=[Image.s3_key], set_=update_cols)
+        await session.execute(stmt)
+
+async def _bulk_upsert_phash_chunks(session, records: List[Dict[str, Any]]):
+    # (s3_key, chunk_no) order, like the image rows
+    rows = [{"s3_key": r["s3_key"], "chunk_no": n, "value": v}
+            for r in _merge_by_s3_key(records) for n, v in enumerate(phash_chunks(r.get("phash")))]
+    for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+        stmt = pg_insert(PhashChunk).values(rows[i:i + _MAX_ROWS_PER_STATEMENT])
+        stmt = stmt.on_conflict_do_update(index_elements=[PhashChunk.s3_key, PhashChunk.chunk_no], set_={"value": stmt.excluded.value})
+        await session.execute(stmt)
+
+async def _bulk_upsert_image_rules(session, records: List[Dict[str, Any]]):
+    pairs = sorted({(r["s3_key"], rid) for r in records for rid in (r.get("rule_ids") or ([r["rule_id"]] if r.get("rule_id") else []))})
+    rows = [{"s3_key": k, "rule_id": rid} for k, rid in pairs]
+    for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+        stmt = pg_insert(ImageRule).values(rows[i:i + _MAX_ROWS_PER_STATEMENT])
+        await session.execute(stmt.on_conflict_do_nothing(index_elements=[ImageRule.s3_key, ImageRule.rule_id]))
+
+async def backfill_phash_chunks(batch_size: int = 1000) -> int:
+    """
+    Write image_phash_chunks for images that have none (hashed before the table existed, or
+    while dedup_backend wasn't "database"), batch_size images per transaction; returns images filled.
+    """
+    filled, after = 0, ""
+    while True:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                rows = (await session.execute(
+                    select(Image.s3_key, Image.phash)
+                    .where(Image.s3_key > after, func.length(Image.phash) == PHASH_CHUNKS * 4,
+                           ~select(PhashChunk.s3_key).where(PhashChunk.s3_key == Image.s3_key).exists())
+                    .order_by(Image.s3_key)
+                    .limit(batch_size))).all()
+                if not rows:
+                    return filled
+                await _bulk_upsert_phash_chunks(session, [{"s3_key": k, "phash": p} for k, p in rows])
+        filled += len(rows)
+        after = rows[-1][0]
+
+def _raw_rows(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Compressed image_rekognition_raw rows for records carrying "rekognition_raw" (last one per key wins)."""
+    rows = {}
+    for r in records:
+        raw = r.get("rekognition_raw")
+        if raw is not None:
+            payload = zlib.compress(json.dumps(raw, separators=(",", ":"), default=str).encode("utf-8"), 6)
+            rows[r["s3_key"]] = {"s3_key": r["s3_key"], "etag": r.get("etag"), "payload": payload}
+    return [rows[k] for k in sorted(rows)]  # lock order, see _merge_by_s3_key
+
+async def _upsert_raw_responses(session, rows: List[Dict[str, Any]]):
+    for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+        stmt = pg_insert(ImageRekognitionRaw).values(rows[i:i + _MAX_ROWS_PER_STATEMENT])
+        stmt = stmt.on_conflict_do_update(index_elements=[ImageRekognitionRaw.s3_key],
+                                          set_={"etag": stmt.excluded.etag, "payload": stmt.excluded.payload, "updated_at": func.now()})
+        await session.execute(stmt)
+    await _clear_legacy_rekognition_json(session, [r["s3_key"] for r in rows])
+
+async def _clear_legacy_rekognition_json(session, s3_keys: List[str]):
+    """Drop images.rekognition_json once the side table holds the responses, so old rows shrink."""
+    for i in range(0, len(s3_keys), _MAX_ROWS_PER_STATEMENT):
+        await session.execute(
+            update(Image)
+            .where(Image.s3_key.in_(s3_keys[i:i + _MAX_ROWS_PER_STATEMENT]), Image.rekognition_json.isnot(None))
+            .values(rekognition_json=None)
+            .execution_options(synchronize_session=False))
+
+async def migrate_legacy_rekognition_json(batch_size: int = 500) -> int:
+    """
+    Move images.rekognition_json blobs written before image_rekognition_raw existed into the
+    side table (compressed), in batches of one transaction each; returns rows moved. A side
+    row that already exists is newer and is kept. Safe to run while audits are being written.
+    """
+    moved = 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                rows = (await session.execute(
+                    select(Image.s3_key, Image.etag, Image.rekognition_json)
+                    .where(Image.rekognition_json.isnot(None))
+                    .order_by(Image.s3_key)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True))).all()
+                if not rows:
+                    return moved
+                raw_rows = await asyncio.to_thread(_raw_rows, [{"s3_key": k, "etag": e, "rekognition_raw": j} for k, e, j in rows])
+                for i in range(0, len(raw_rows), _MAX_ROWS_PER_STATEMENT):
+                    stmt = pg_insert(ImageRekognitionRaw).values(raw_rows[i:i + _MAX_ROWS_PER_STATEMENT])
+                    await session.execute(stmt.on_conflict_do_nothing(index_elements=[ImageRekognitionRaw.s3_key]))
+                await _clear_legacy_rekognition_json(session, [r[0] for r in rows])
+        moved += len(rows)
+
+async def _bulk_insert_audits(session, records: List[Dict[str, Any]]):
+    rows = _normalize_rows(records, Audit)
+    for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+        await session.execute(insert(Audit).values(rows[i:i + _MAX_ROWS_PER_STATEMENT]))
+
+# -------------------------
+# Daily compliance rollups
+# -------------------------
+def reason_codes(reason: Optional[str]) -> List[str]:
+    """'labels_missing|REPEATED' -> ['labels_missing', 'REPEATED']; 'download_error:boom' -> ['download_error']."""
+    if not reason:
+        return []
+    return [part.split(":", 1)[0] for part in reason.split("|") if part]
+
+def _rollup_counts(audits: List[Dict[str, Any]]) -> Tuple[Counter, Counter]:
+    statuses, reasons = Counter(), Counter()
+    for a in audits:
+        processed_at = _to_db_datetime(a.get("processed_at")) or datetime.utcnow()
+        base = (processed_at.date(), a.get("store_id") or "", a["rule_id"])
+        statuses[base + (a["status"],)] += 1
+        for code in reason_codes(a.get("reason")):
+            reasons[base + (code,)] += 1
+    return statuses, reasons
+
+async def _upsert_counts(session, model, key: str, counts: Counter):
+    # sorted so concurrent flushes lock the same rollup rows in the same order (no deadlocks)
+    rows = [{"day": d, "store_id": s, "rule_id": r, key: k, "count": n} for (d, s, r, k), n in sorted(counts.items())]
+    for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+        stmt = pg_insert(model).values(rows[i:i + _MAX_ROWS_PER_STATEMENT])
+        stmt = stmt.on_conflict_do_update(index_elements=["day", "store_id", "rule_id", key],
+                                          set_={"count": model.count + stmt.excluded.count})
+        await session.execute(stmt)
+
+async def _upsert_rollups(session, audits: List[Dict[str, Any]]):
+    audits = [a for a in audits if a.get("rule_id") and a.get("status")]
+    if not audits:
+        return
+    statuses, reasons = _rollup_counts(audits)
+    await _upsert_counts(session, AuditDailyStatus, "status", statuses)
+    if reasons:
+        await _upsert_counts(session, AuditDailyReason, "reason", reasons)
+
+# same counts as _rollup_counts, computed in Postgres; reason codes are the "|"-separated
+# parts of audits.reason up to the first ":" (see reason_codes)
+_ROLLUP_REBUILD = [
+    """
+    INSERT INTO audit_daily_status (day, store_id, rule_id, status, count)
+    SELECT processed_at::date, COALESCE(store_id, ''), rule_id, status, count(*)
+    FROM audits
+    WHERE processed_at IS NOT NULL AND rule_id IS NOT NULL AND status IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+    """,
+    """
+    INSERT INTO audit_daily_reasons (day, store_id, rule_id, reason, count)
+    SELECT a.processed_at::date, COALESCE(a.store_id, ''), a.rule_id, split_part(r.part, ':', 1), count(*)
+    FROM audits a CROSS JOIN LATERAL unnest(string_to_array(a.reason, '|')) AS r(part)
+    WHERE a.processed_at IS NOT NULL AND a.rule_id IS NOT NULL AND a.status IS NOT NULL AND r.part <> ''
+    GROUP BY 1, 2, 3, 4
+    """,
+]
+
+async def rebuild_rollups() -> Dict[str, int]:
+    """
+    Recompute both rollup tables from audits (e.g. once for audits written before they existed);
+    returns rows written per table. The tables stay locked until it commits: write_batch calls
+    that bump them wait and are counted exactly once, and concurrent rebuilds run one at a time.
+    """
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(text("LOCK TABLE audit_daily_status, audit_daily_reasons IN SHARE ROW EXCLUSIVE MODE"))
+            await session.execute(delete(AuditDailyStatus))
+            await session.execute(delete(AuditDailyReason))
+            counts = [(await session.execute(text(stmt))).rowcount for stmt in _ROLLUP_REBUILD]
+    return {"audit_daily_status": counts[0], "audit_daily_reasons": counts[1]}
+
+async def get_compliance_summary(store_id: str = None, rule_id: str = None, since: date = None, until: date = None,
+                                 by_day: bool = False) -> List[Dict[str, Any]]:
+    """
+    Status and reason counts per store/rule (and per day with by_day) from the rollup tables;
+    since/until are inclusive UTC days. pass_rate is PASS / all audits.
+    """
+    async def fetch(session, model, key):
+        cols = [model.store_id, model.rule_id] + ([model.day] if by_day else [])
+        stmt = select(*cols, getattr(model, key), func.sum(model.count))
+        if store_id is not None:
+            stmt = stmt.where(model.store_id == store_id)
+        if rule_id is not None:
+            stmt = stmt.where(model.rule_id == rule_id)
+        if since is not None:
+            stmt = stmt.where(model.day >= since)
+        if until is not None:
+            stmt = stmt.where(model.day <= until)
+        stmt = stmt.group_by(*cols, getattr(model, key))
+        return (await session.execute(stmt)).all()
+
+    async with AsyncSessionLocal() as session:
+        status_rows = await fetch(session, AuditDailyStatus, "status")
+        reason_rows = await fetch(session, AuditDailyReason, "reason")
+
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    def group(row) -> Dict[str, Any]:
+        gkey = tuple(row[:-2])
+        g = groups.get(gkey)
+        if g is None:
+            g = groups[gkey] = {"store_id": row[0] or None, "rule_id": row[1], **({"day": row[2].isoformat()} if by_day else {}),
+                                "total": 0, "statuses": {}, "reasons": {}}
+        return g
+    for row in status_rows:
+        g = group(row)
+        g["statuses"][row[-2]] = int(row[-1])
+        g["total"] += int(row[-1])
+    for row in reason_rows:
+        group(row)["reasons"][row[-2]] = int(row[-1])
+    out = sorted(groups.values(), key=lambda g: (g["store_id"] or "", g["rule_id"], g.get("day", "")))
+    for g in out:
+        g["pass_rate"] = round(g["statuses"].get("PASS", 0) / g["total"], 4) if g["total"] else None
+    return out
+
+async def write_batch(images: List[Dict[str, Any]], audits: List[Dict[str, Any]]):
+    """Upsert image records, insert audit rows and bump their daily rollups in a single transaction."""
+    if not images and not audits:
+        return
+    # compress raw responses off the event loop before taking a connection
+    raw_rows = await asyncio.to_thread(_raw_rows, images) if images else []
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            if images:
+                await _bulk_upsert_images(session, images)
+                if settings.dedup_backend == "database":  # only find_phash_match reads the chunks
+                    await _bulk_upsert_phash_chunks(session, images)
+                await _bulk_upsert_image_rules(session, images)
+                await _upsert_raw_responses(session, raw_rows)
+            if audits:
+                await _bulk_insert_audits(session, audits)
+                await _upsert_rollups(session, audits)
+
+async def get_rekognition_raw(s3_key: str) -> Optional[Dict[str, Any]]:
+    """Full Rekognition responses of an image, or None; falls back to legacy images.rekognition_json."""
+    async with AsyncSessionLocal() as session:
+        payload = (await session.execute(select(ImageRekognitionRaw.payload).where(ImageRekognitionRaw.s3_key == s3_key))).scalar_one_or_none()
+        if payload is not None:
+            return json.loads(zlib.decompress(payload))
+        return (await session.execute(select(Image.rekognition_json).where(Image.s3_key == s3_key))).scalar_one_or_none()
+
+async def get_audited_versions(s3_keys: List[str], rule_ids: List[str]) -> set:
+    """(s3_key, rule_id, etag) triples that already have a non-ERROR audit row."""
+    if not s3_keys:
+        return set()
+    async with AsyncSessionLocal() as session:
+        stmt = select(Audit.s3_key, Audit.rule_id, Audit.etag).where(
+            Audit.s3_key.in_(s3_keys), Audit.rule_id.in_(rule_ids), Audit.etag.isnot(None), Audit.status != "ERROR"
+        ).distinct()
+        res = await session.execute(stmt)
+        return {tuple(r) for r in res.all()}
+
+async def get_phashes_by_etag(etags: List[str]) -> Dict[str, str]:
+    """ETag -> stored pHash, so unchanged content can skip the download and re-hash."""
+    etags = [e for e in set(etags) if e]
+    if not etags:
+        return {}
+    async with AsyncSessionLocal() as session:
+        stmt = select(Image.etag, Image.phash).where(Image.etag.in_(etags), Image.phash.isnot(None))
         res = await session.execute(stmt)
-        return [r for r in res.scalars().all() if r]
+        return {e: p for e, p in res.all()}
+
+# -------------------------
+# Background audit jobs
+# -------------------------
+async def create_job(job: Dict[str, Any]):
+    async with AsyncSessionLocal() as session:
+        session.add(AuditJob(**job))
+        await session.commit()
+
+async def update_job(job_id: str, fields: Dict[str, Any]) -> bool:
+    """Update a job row; returns True if a cancel has been requested for it."""
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(update(AuditJob).where(AuditJob.id == job_id).values(**fields).returning(AuditJob.cancel_requested))
+        await session.commit()
+        return bool(res.scalar_one_or_none())
+
+async def get_job(job_id: str):
+    async with AsyncSessionLocal() as session:
+        return await session.get(AuditJob, job_id)
+
+async def request_job_cancel(job_id: str):
+    async with AsyncSessionLocal() as session:
+        job = await session.get(AuditJob, job_id)
+        if job is None:
+            return None
+        if job.status in ("QUEUED", "LISTING", "RUNNING"):
+            job.cancel_requested = True
+            await session.commit()
+        return job
+
+async def interrupt_stale_jobs(stale_seconds: float, job_id: str = None) -> int:
+    """
+    Mark jobs INTERRUPTED whose process died without a graceful shutdown (OOM, SIGKILL, lost
+    node): QUEUED/LISTING/RUNNING rows not written for stale_seconds. Running jobs write
+    progress every job_progress_interval; distributed RUNNING jobs are driven by the work
+    queue instead and are left alone.
+    """
+    cutoff = func.now() - timedelta(seconds=stale_seconds)
+    stmt = (update(AuditJob)
+            .where(AuditJob.status.in_(("QUEUED", "LISTING", "RUNNING")), AuditJob.updated_at < cutoff,
+                   ~((AuditJob.status == "RUNNING") & (AuditJob.distributed.is_(True))))
+            .values(status="INTERRUPTED", finished_at=func.now())
+            .returning(AuditJob.id))
+    if job_id is not None:
+        stmt = stmt.where(AuditJob.id == job_id)
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(stmt)
+        await session.commit()
+        return len(res.all())
+
+# -------------------------
+# Distributed work queue (worker.py)
+# -------------------------
+_CLAIMABLE_JOB_STATUSES = ("LISTING", "RUNNING")
+
+async def enqueue_work_items(job_id: str, items: List[Dict[str, Any]]) -> int:
+    """Add objects of a job to the queue (re-listing is idempotent); returns rows inserted."""
+    if not items:
+        return 0
+    rows = _normalize_rows([{**i, "job_id": job_id, "status": "PENDING", "attempts": 0} for i in items], WorkItem)
+    inserted = 0
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            for i in range(0, len(rows), _MAX_ROWS_PER_STATEMENT):
+                stmt = pg_insert(WorkItem).values(rows[i:i + _MAX_ROWS_PER_STATEMENT])
+                stmt = stmt.on_conflict_do_nothing(index_elements=["job_id", "s3_key"]).returning(WorkItem.id)
+                inserted += len((await session.execute(stmt)).all())
+    return inserted
+
+async def claim_work_items(worker_id: str, limit: int, lease_seconds: float, max_attempts: int) -> List[WorkItem]:
+    """
+    Lease up to `limit` PENDING or lease-expired items of running, non-cancelled jobs.
+    SKIP LOCKED lets any number of workers claim concurrently without waiting on each other;
+    items that used up max_attempts claims (lease ran out, or released after errors) are
+    marked FAILED instead, and jobs left without open items by that are finished.
+    """
+    now = func.now()
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            exhausted = await session.execute(
+                update(WorkItem)
+                .where(WorkItem.attempts >= max_attempts,
+                       (WorkItem.status == "PENDING") | ((WorkItem.status == "LEASED") & (WorkItem.lease_until < now)))
+                .values(status="FAILED", error=func.coalesce(WorkItem.error, f"lease expired {max_attempts} times"),
+                        worker_id=None, lease_until=None)
+                .returning(WorkItem.job_id)
+                .execution_options(synchronize_session=False))
+            failed_jobs = sorted({r[0] for r in exhausted.all()})
+            claimable = (
+                select(WorkItem.id)
+                .join(AuditJob, AuditJob.id == WorkItem.job_id)
+                .where(AuditJob.status.in_(_CLAIMABLE_JOB_STATUSES), AuditJob.cancel_requested.isnot(True),
+                       ((WorkItem.status == "PENDING") | ((WorkItem.status == "LEASED") & (WorkItem.lease_until < now))))
+                .order_by(WorkItem.id)
+                .limit(limit)
+                .with_for_update(of=WorkItem, skip_locked=True)
+            )
+            stmt = (update(WorkItem)
+                    .where(WorkItem.id.in_(claimable.scalar_subquery()))
+                    .values(status="LEASED", worker_id=worker_id, attempts=WorkItem.attempts + 1,
+                            lease_until=now + timedelta(seconds=lease_seconds))
+                    .returning(WorkItem)
+                    .execution_options(synchronize_session=False))
+            items = list((await session.execute(stmt)).scalars().all())
+    await finish_drained_jobs(failed_jobs)
+    return items
+
+async def extend_work_leases(ids: List[int], worker_id: str, lease_seconds: float) -> int:
+    """Push the lease of items this worker still holds; returns how many it still holds."""
+    if not ids:
+        return 0
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            update(WorkItem)
+            .where(WorkItem.id.in_(ids), WorkItem.worker_id == worker_id, WorkItem.status == "LEASED")
+            .values(lease_until=func.now() + timedelta(seconds=lease_seconds))
+            .returning(WorkItem.id))
+        await session.commit()
+        return len(res.all())
+
+async def complete_work_items(worker_id: str, results: Dict[int, str]):
+    """Mark items DONE with their overall audit status (only those this worker still holds)."""
+    if not results:
+        return
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            by_status: Dict[str, List[int]] = {}
+            for item_id, status in results.items():
+                by_status.setdefault(status, []).append(item_id)
+            for status, ids in by_status.items():
+                await session.execute(
+                    update(WorkItem)
+                    .where(WorkItem.id.in_(ids), WorkItem.worker_id == worker_id, WorkItem.status == "LEASED")
+                    .values(status="DONE", result_status=status, lease_until=None, error=None))
+
+async def release_work_items(worker_id: str, errors: Dict[int, str]):
+    """Put items back to PENDING after an unexpected error so another claim retries them."""
+    if not errors:
+        return
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            for item_id, error in errors.items():
+                await session.execute(
+                    update(WorkItem)
+                    .where(WorkItem.id == item_id, WorkItem.worker_id == worker_id, WorkItem.status == "LEASED")
+                    .values(status="PENDING", worker_id=None, lease_until=None, error=error))
+
+async def fail_work_items(ids: List[int], error: str):
+    if not ids:
+        return
+    async with AsyncSessionLocal() as session:
+        await session.execute(update(WorkItem).where(WorkItem.id.in_(ids)).values(status="FAILED", lease_until=None, error=error))
+        await session.commit()
+
+async def get_work_item_counts(job_id: str) -> Dict[str, int]:
+    """Item counts of a job by queue status, plus "errors" (FAILED items and objects audited as ERROR)."""
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            select(WorkItem.status, WorkItem.result_status, func.count()).where(WorkItem.job_id == job_id)
+            .group_by(WorkItem.status, WorkItem.result_status))).all()
+    counts = {"PENDING": 0, "LEASED": 0, "DONE": 0, "FAILED": 0, "errors": 0}
+    for status, result_status, n in rows:
+        counts[status] = counts.get(status, 0) + n
+        if status == "FAILED" or result_status == "ERROR":
+            counts["errors"] += n
+    return counts
+
+async def finish_drained_jobs(job_ids: List[str]) -> List[str]:
+    """Mark RUNNING (listing finished) jobs without PENDING/LEASED items as DONE; returns their ids."""
+    if not job_ids:
+        return []
+    open_items = select(WorkItem.id).where(WorkItem.job_id == AuditJob.id, WorkItem.status.in_(("PENDING", "LEASED"))).exists()
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            update(AuditJob)
+            .where(AuditJob.id.in_(job_ids), AuditJob.status == "RUNNING", ~open_items)
+            .values(status="DONE", finished_at=func.now())
+            .returning(AuditJob.id))
+        await session.commit()
+        return [r[0] for r in res.all()]
+
+# -------------------------
+# Read API (keyset pagination)
+# -------------------------
+AUDIT_COLUMNS = (Audit.id, Audit.run_id, Audit.rule_id, Audit.store_id, Audit.s3_key, Audit.status, Audit.reason,
+                 Audit.processed_at, Audit.etag, Audit.object_last_modified)
+IMAGE_COLUMNS = (Image.id, Image.s3_key, Image.file_url, Image.store_id, Image.rule_id, Image.captured_at, Image.processed_at,
+                 Image.phash, Image.etag, Image.face_count, Image.is_repeated, Image.rekognition_summary)
+
+def encode_cursor(processed_at: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([processed_at.isoformat(), row_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor."""
+    try:
+        ts, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(ts), int(row_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+async def _keyset_page(model, columns, filters: List[Any], limit: int, cursor: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Newest first by (processed_at, id); the cursor is the last row of the previous page."""
+    stmt = select(*columns).where(model.processed_at.isnot(None), *filters)
+    if cursor:
+        ts, row_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(model.processed_at, model.id) < tuple_(literal(ts, DateTime), literal(row_id)))
+    stmt = stmt.order_by(model.processed_at.desc(), model.id.desc()).limit(limit + 1)
+    async with AsyncSessionLocal() as session:
+        rows = [dict(r._mapping) for r in (await session.execute(stmt)).all()]
+    next_cursor = encode_cursor(rows[limit - 1]["processed_at"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+async def list_audits(store_id: str = None, rule_id: str = None, status: str = None, run_id: str = None,
+                      since: datetime = None, until: datetime = None, limit: int = 100, cursor: str = None):
+    """Audit rows matching the filters, newest first -> (rows, next_cursor)."""
+    filters = []
+    if store_id is not None:
+        filters.append(Audit.store_id == store_id)
+    if rule_id is not None:
+        filters.append(Audit.rule_id == rule_id)
+    if status is not None:
+        filters.append(Audit.status == status)
+    if run_id is not None:
+        filters.append(Audit.run_id == run_id)
+    if since is not None:
+        filters.append(Audit.processed_at >= _to_db_datetime(since))
+    if until is not None:
+        filters.append(Audit.processed_at < _to_db_datetime(until))
+    return await _keyset_page(Audit, AUDIT_COLUMNS, filters, limit, cursor)
+
+async def list_images(store_id: str = None, rule_id: str = None, prefix: str = None, is_repeated: bool = None,
+                      since: datetime = None, until: datetime = None, limit: int = 100, cursor: str = None):
+    """Image rows (summary only, no raw responses) matching the filters, newest first -> (rows, next_cursor)."""
+    filters = []
+    if store_id is not None:
+        filters.append(Image.store_id == store_id)
+    if rule_id is not None:
+        # probe on the image_rules primary key (s3_key, rule_id) per row of the (processed_at, id) scan
+        filters.append(select(ImageRule.s3_key).where(ImageRule.s3_key == Image.s3_key, ImageRule.rule_id == rule_id).exists())
+    if prefix:
+        filters.append(Image.s3_key.like(f"{prefix}%"))
+    if is_repeated is not None:
+        filters.append(Image.is_repeated == is_repeated)
+    if since is not None:
+        filters.append(Image.processed_at >= _to_db_datetime(since))
+    if until is not None:
+        filters.append(Image.processed_at < _to_db_datetime(until))
+    return await _keyset_page(Image, IMAGE_COLUMNS, filters, limit, cursor)
@@ -1,3 +1,4 @@
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from config import settings
@@ -6,6 +7,28 @@ engine = create_async_engine(settings.database_url, future=True, echo=False)
 AsyncSessionLocal = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
 
+# create_all only creates missing tables; columns/indexes added to existing tables go here
+SCHEMA_UPGRADES = [
+    "ALTER TABLE images ADD COLUMN IF NOT EXISTS etag VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_images_etag ON images (etag)",
+    "ALTER TABLE images ADD COLUMN IF NOT EXISTS phash_bits BYTEA",
+    "ALTER TABLE images ADD COLUMN IF NOT EXISTS rekognition_summary JSONB",
+    "ALTER TABLE audits ADD COLUMN IF NOT EXISTS etag VARCHAR",
+    "ALTER TABLE audits ADD COLUMN IF NOT EXISTS object_last_modified TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_audits_key_rule_etag ON audits (s3_key, rule_id, etag)",
+    "ALTER TABLE audits ADD COLUMN IF NOT EXISTS store_id VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_audits_store_rule_status_time ON audits (store_id, rule_id, status, processed_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_audits_rule_status_time ON audits (rule_id, status, processed_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_audits_time ON audits (processed_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_images_store_time ON images (store_id, processed_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_images_time ON images (processed_at, id)",
+    "ALTER TABLE audit_jobs ADD COLUMN IF NOT EXISTS incremental BOOLEAN DEFAULT FALSE",
+    "ALTER TABLE audit_jobs ADD COLUMN IF NOT EXISTS skipped INTEGER DEFAULT 0",
+    "ALTER TABLE audit_jobs ADD COLUMN IF NOT EXISTS distributed BOOLEAN DEFAULT FALSE",
+]
+
 async def create_db_and_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for stmt in SCHEMA_UPGRADES:
+            await conn.execute(text(stmt))
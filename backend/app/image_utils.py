@@ -1,6 +1,16 @@
-from PIL import Image
+from PIL import Image, ImageOps
 import imagehash
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 def compute_phash(image_bytes: bytes, hash_size: int = 16) -> str:
     img = Image.open(BytesIO(image_bytes)).convert("RGB")
@@ -8,3 +18,106 @@ def compute_phash(image_bytes: bytes, hash_size: int = 16) -> str:
 
 def phash_hamming_distance(hex1: str, hex2: str) -> int:
     return (int(hex1, 16) ^ int(hex2, 16)).bit_count()
+
+def phash_to_bytes(phash_hex: Optional[str]) -> Optional[bytes]:
+    """Fixed-width binary form of a hex pHash (images.phash_bits)."""
+    return bytes.fromhex(phash_hex) if phash_hex else None
+
+REKOGNITION_MAX_BYTES = 5 * 1024 * 1024  # Image.Bytes limit
+_EXIF_ORIENTATION = 0x0112
+
+def prepare_image(image_bytes: bytes, hash_size: int = 16, max_upload_bytes: int = REKOGNITION_MAX_BYTES,
+                  max_dimension: int = 1920) -> Tuple[str, Optional[str], Optional[bytes]]:
+    """
+    One decode for both hashing and the Rekognition upload. Runs in the process pool.
+    Returns (sha256 hex digest, pHash, upload bytes). pHash is None if the image can't be
+    decoded; upload bytes are None when the original can be sent as-is (JPEG/PNG, upright,
+    within max_dimension and max_upload_bytes), else an upright JPEG capped to both.
+    JPEGs are decoded at reduced scale (draft mode): just big enough for the upload when
+    re-encoding, otherwise grayscale at 2x the pHash input size (4*hash_size), which keeps
+    hashes within a few bits of full-resolution ones.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        img = Image.open(BytesIO(image_bytes))
+        orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+        w, h = img.size
+        reencode = (img.format not in ("JPEG", "PNG") or orientation != 1
+                    or max(w, h) > max_dimension or len(image_bytes) > max_upload_bytes)
+        target = max_dimension if reencode else hash_size * 8
+        scale = min(1.0, target / max(w, h))
+        img.draft("RGB" if reencode else "L", (max(1, int(w * scale)), max(1, int(h * scale))))
+        img = ImageOps.exif_transpose(img)
+        phash = str(imagehash.phash(img, hash_size=hash_size))
+        upload = _encode_upload(img, max_upload_bytes, max_dimension) if reencode else None
+    except Exception:
+        return digest, None, None
+    return digest, phash, upload
+
+def _encode_upload(img: Image.Image, max_bytes: int, max_dimension: int) -> bytes:
+    img = img.convert("RGB")
+    img.thumbnail((max_dimension, max_dimension))
+    while True:
+        for quality in (85, 70, 55):
+            buf = BytesIO()
+            img.save(buf, format="JPEG", quality=quality, optimize=True)
+            if buf.tell() <= max_bytes:
+                return buf.getvalue()
+        # still too big at low quality: shrink and retry
+        img.thumbnail((int(img.width * 0.75), int(img.height * 0.75)))
+
+# -------------------------
+# Process pool for CPU-bound image work
+# -------------------------
+# Decoding a 4-8 MB photo takes tens of ms; doing it on the event loop stalls every
+# other coroutine. Work is sent to worker processes instead: the bytes are pickled once
+# into the worker and only the digest/hash (and a capped upload JPEG if needed) come back.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers: Optional[int] = None
+_pool_lock = threading.Lock()
+
+def _new_pool(max_workers: Optional[int]) -> ProcessPoolExecutor:
+    # spawn: forking a process that already runs an event loop and threads is unsafe
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+def init_process_pool(max_workers: Optional[int] = None):
+    """
+    Create the shared pool. max_workers=None uses every core; 0 disables the pool and
+    runs image work in the default thread executor instead.
+    """
+    global _pool, _pool_workers
+    shutdown_process_pool()
+    _pool_workers = max_workers
+    if max_workers != 0:
+        _pool = _new_pool(max_workers)
+
+def shutdown_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def _replace_broken_pool(broken: ProcessPoolExecutor) -> Optional[ProcessPoolExecutor]:
+    """Swap a pool whose worker died (crash, OOM kill) for a new one; callers that saw the same pool break share one rebuild."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            logger.warning("image process pool broke (a worker died); starting a new one")
+            broken.shutdown(wait=False, cancel_futures=True)
+            _pool = _new_pool(_pool_workers)
+        return _pool
+
+async def run_in_pool(func, *args):
+    """
+    Run a picklable top-level function from this module in the pool (or a thread if disabled).
+    A broken pool fails every later submit, so it is replaced and the call retried once.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pool
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        if pool is None:
+            raise
+        return await loop.run_in_executor(_replace_broken_pool(pool), func, *args)
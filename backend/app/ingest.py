@@ -0,0 +1,277 @@
+# ingest.py
+"""
+Continuous audits from S3 event notifications instead of prefix listing.
+
+The bucket sends ObjectCreated events (directly or through SNS) to an SQS queue
+(settings.sqs_queue_url; settings.sqs_endpoint_url for ElasticMQ / moto locally).
+Each new key is matched against ingest_routes.json and audited with the matching
+rules as soon as it is received:
+
+    [{"pattern": "*/Signage*/*", "group": "Store Front", "store_segment": 0},
+     {"pattern": "*/CRE/*", "rule_ids": ["rule_cre_group"], "store_segment": 0}]
+
+pattern is a case-insensitive glob on the key; rule_ids/group/section select rules as
+in /run_audit; store_segment is the key path segment used as store_id. Rules of every
+matching route are combined.
+
+    python ingest.py
+
+A message is deleted (in batches of 10) once the audits of all its objects have been
+flushed; while objects are still being audited the visibility timeout of their messages
+is extended in batches. Messages that cannot be parsed, or with an object whose audit
+ended in ERROR (failed download, Rekognition error), are not deleted, so the queue
+redelivers them (and its redrive policy applies). Rules already audited at the object's
+ETag are skipped on redelivery.
+"""
+import asyncio
+import fnmatch
+import json
+import logging
+import re
+import signal
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote_plus
+from config import settings
+from database import create_db_and_tables, engine
+from image_utils import init_process_pool, shutdown_process_pool
+from persistence import WriteBehindBatcher
+from pipeline import RunContext, _pending_rules, _process_object
+from rule_engine import get_rules
+from rules_loader import select_rules
+from s3_rek_client import close_clients, delete_messages, extend_visibility, receive_messages, start_clients
+
+logger = logging.getLogger("ingest")
+
+MAX_CONTEXTS = 32  # run contexts (compiled rules, pHash indexes) kept for recently seen (rules, store) pairs
+
+# -------------------------
+# Routes: key pattern -> rules
+# -------------------------
+@dataclass
+class Route:
+    pattern: str
+    rule_ids: List[str]
+    store_segment: Optional[int] = None
+    regex: re.Pattern = field(init=False)
+
+    def __post_init__(self):
+        self.regex = re.compile(fnmatch.translate(self.pattern), re.IGNORECASE)
+
+def load_routes(path: Path) -> List[Route]:
+    """Parse ingest_routes.json against the current rules; unknown rule ids raise KeyError."""
+    rules = get_rules().raw
+    routes = []
+    with open(path, "r", encoding="utf-8") as f:
+        for r in json.load(f):
+            rule_ids = select_rules(rules, r.get("rule_ids"), r.get("group"), r.get("section"))
+            if not rule_ids:
+                raise ValueError(f"route {r['pattern']!r} selects no rules")
+            routes.append(Route(r["pattern"], rule_ids, r.get("store_segment")))
+    return routes
+
+def route_key(routes: List[Route], key: str) -> Tuple[List[str], Optional[str]]:
+    """(rule ids of every matching route, store id from the first route that names one)."""
+    rule_ids, store_id = [], None
+    for route in routes:
+        if not route.regex.match(key):
+            continue
+        rule_ids.extend(r for r in route.rule_ids if r not in rule_ids)
+        if store_id is None and route.store_segment is not None:
+            parts = key.split("/")
+            if route.store_segment < len(parts) - 1:
+                store_id = parts[route.store_segment]
+    return rule_ids, store_id
+
+# -------------------------
+# S3 event parsing
+# -------------------------
+def parse_s3_event(body: str) -> List[dict]:
+    """
+    Objects created according to one SQS message body (S3 event, or S3 event wrapped in an
+    SNS notification), as pipeline objects plus their bucket. s3:TestEvent yields [].
+    """
+    event = json.loads(body)
+    if "Message" in event and event.get("Type") == "Notification":
+        event = json.loads(event["Message"])
+    objs = []
+    for record in event.get("Records", []):
+        if not record.get("eventName", "").startswith("ObjectCreated"):
+            continue
+        s3 = record["s3"]
+        ts = record.get("eventTime")
+        objs.append({"Bucket": s3["bucket"]["name"], "Key": unquote_plus(s3["object"]["key"]), "Size": s3["object"].get("size"),
+                     "ETag": (s3["object"].get("eTag") or "").strip('"') or None,
+                     "LastModified": datetime.fromisoformat(ts.replace("Z", "+00:00")) if ts else None})
+    return objs
+
+# -------------------------
+# Consumer
+# -------------------------
+@dataclass
+class _Message:
+    receipt: str
+    pending: int  # objects of the message not audited yet
+    received: float = field(default_factory=time.monotonic)
+
+class IngestConsumer:
+    """
+    Receives messages, audits their objects concurrently (at most sqs_max_in_flight) and
+    acknowledges finished messages from a background loop that flushes audits first.
+    """
+    def __init__(self, queue_url: str, routes: List[Route]):
+        self.queue_url = queue_url
+        self.routes = routes
+        self.stopping = asyncio.Event()
+        self._slots = asyncio.Semaphore(settings.sqs_max_in_flight)
+        self._inflight: Dict[str, _Message] = {}  # message id -> state
+        self._done: List[str] = []  # receipt handles ready to delete once audits are flushed
+        self._contexts: "OrderedDict[Tuple[Tuple[str, ...], Optional[str]], RunContext]" = OrderedDict()
+        self._tasks: set = set()
+        self.batcher = WriteBehindBatcher(settings.db_batch_size, settings.db_flush_interval)
+
+    def _context(self, rule_ids: List[str], store_id: Optional[str]) -> RunContext:
+        """
+        One long-lived run per (rules, store); renewed so the in-memory pHash index is reloaded,
+        and only the MAX_CONTEXTS most recently used are kept.
+        """
+        key = (tuple(rule_ids), store_id)
+        ctx = self._contexts.get(key)
+        if ctx is None or time.monotonic() - ctx.started > settings.ingest_context_max_age:
+            ctx = RunContext(rule_ids, store_id, incremental=True, batcher=self.batcher)
+        self._contexts[key] = ctx
+        self._contexts.move_to_end(key)
+        while len(self._contexts) > MAX_CONTEXTS:
+            self._contexts.popitem(last=False)
+        return ctx
+
+    async def run(self):
+        async with self.batcher:
+            ack = asyncio.create_task(self._ack_loop())
+            heartbeat = asyncio.create_task(self._visibility_loop())
+            try:
+                while not self.stopping.is_set():
+                    messages = await receive_messages(self.queue_url, 10, settings.sqs_wait_seconds, settings.sqs_visibility_timeout)
+                    for m in messages:
+                        await self._dispatch(m)
+                if self._tasks:
+                    await asyncio.gather(*self._tasks, return_exceptions=True)
+                await self._acknowledge()
+            finally:
+                ack.cancel()
+                heartbeat.cancel()
+                await asyncio.gather(ack, heartbeat, return_exceptions=True)
+
+    async def _dispatch(self, message: dict):
+        try:
+            objs = parse_s3_event(message["Body"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("unparseable message %s left for redrive", message.get("MessageId"))
+            return
+        work = []
+        for o in objs:
+            if o.pop("Bucket") != settings.s3_bucket:
+                logger.warning("ignoring %s from another bucket", o["Key"])
+                continue
+            rule_ids, store_id = route_key(self.routes, o["Key"])
+            if rule_ids:
+                work.append((o, self._context(rule_ids, store_id)))
+        if not work:
+            self._done.append(message["ReceiptHandle"])
+            return
+        self._inflight[message["MessageId"]] = _Message(message["ReceiptHandle"], len(work))
+        for o, ctx in work:
+            await self._slots.acquire()  # backpressure: stop receiving while the consumer is full
+            task = asyncio.create_task(self._audit(message["MessageId"], o, ctx))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _audit(self, message_id: str, obj: dict, ctx: RunContext):
+        try:
+            rule_ids = (await _pending_rules([obj], ctx))[0]
+            if rule_ids:
+                result = await _process_object(obj, ctx, rule_ids)
+                ctx.record(result)
+                logger.info("%s %s", obj["Key"], result["status"])
+                if result["status"] == "ERROR" or any(r["status"] == "ERROR" for r in (result.get("rules") or {}).values()):
+                    # download/hash/Rekognition failures come back as ERROR results; leave the message
+                    # for redelivery (incremental runs skip the rules that did succeed)
+                    self._inflight.pop(message_id, None)
+                    return
+            else:
+                ctx.skipped += 1
+        except Exception:
+            # not acknowledged: the message becomes visible again and is redelivered
+            logger.exception("audit of %s failed", obj["Key"])
+            self._inflight.pop(message_id, None)
+            return
+        finally:
+            self._slots.release()
+        state = self._inflight.get(message_id)
+        if state is not None:
+            state.pending -= 1
+            if state.pending == 0:
+                self._done.append(self._inflight.pop(message_id).receipt)
+
+    async def _acknowledge(self):
+        if not self._done:
+            return
+        receipts, self._done = self._done, []
+        await self.batcher.flush()  # audits are durable before their messages go away
+        failed = await delete_messages(self.queue_url, receipts)
+        if failed:
+            logger.warning("%d message deletes failed; they will be redelivered", len(failed))
+
+    async def _ack_loop(self):
+        while True:
+            await asyncio.sleep(1.0)
+            try:
+                await self._acknowledge()
+            except Exception:
+                logger.exception("acknowledging messages failed")
+
+    async def _visibility_loop(self):
+        interval = max(1.0, settings.sqs_visibility_timeout / 3)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            receipts = [m.receipt for m in self._inflight.values() if now - m.received >= interval]
+            if not receipts:
+                continue
+            try:
+                await extend_visibility(self.queue_url, receipts, settings.sqs_visibility_timeout)
+            except Exception:
+                logger.exception("extending visibility of %d messages failed", len(receipts))
+
+async def main():
+    if not settings.sqs_queue_url:
+        raise SystemExit("set SQS_QUEUE_URL to the queue receiving the bucket's ObjectCreated events")
+    try:
+        routes = load_routes(Path(settings.ingest_routes_path))
+    except (OSError, KeyError, ValueError) as e:
+        raise SystemExit(f"invalid routes file {settings.ingest_routes_path}: {e!r}")
+    await create_db_and_tables()
+    await start_clients()
+    init_process_pool(settings.image_workers)
+    consumer = IngestConsumer(settings.sqs_queue_url, routes)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, consumer.stopping.set)  # finish in-flight objects, then exit
+        except NotImplementedError:  # Windows
+            pass
+    logger.info("consuming %s with %d routes", settings.sqs_queue_url, len(routes))
+    try:
+        await consumer.run()
+    finally:
+        shutdown_process_pool()
+        await close_clients()
+        await engine.dispose()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main())
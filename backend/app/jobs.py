@@ -0,0 +1,183 @@
+# jobs.py
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+from config import settings
+from crud import create_job, update_job, get_job, request_job_cancel, interrupt_stale_jobs, enqueue_work_items, finish_drained_jobs, get_work_item_counts
+from pipeline import RunContext, pending_object_pages, stream_pipeline_for_prefix
+
+logger = logging.getLogger(__name__)
+
+STALE_AFTER_INTERVALS = 6  # a QUEUED/RUNNING job not written for this many progress intervals has lost its process
+
+def job_to_dict(job, work_counts: Optional[Dict[str, int]] = None) -> dict:
+    processed, failed = job.processed, job.failed
+    remaining = max((job.listed or 0) - (job.skipped or 0) - (job.processed or 0), 0)
+    if work_counts is not None:
+        # distributed jobs: progress lives in audit_work_items, written by the workers
+        processed, failed = work_counts["DONE"] + work_counts["FAILED"], work_counts["errors"]
+        remaining = work_counts["PENDING"] + work_counts["LEASED"]
+    return {
+        "job_id": job.id, "prefix": job.prefix, "rule_ids": job.rule_ids, "store_id": job.store_id, "incremental": job.incremental,
+        "distributed": bool(job.distributed), "status": job.status, "listed": job.listed, "skipped": job.skipped,
+        "processed": processed, "failed": failed, "remaining": remaining, "images_per_s": job.images_per_s,
+        "cancel_requested": job.cancel_requested,
+        "error": job.error, "created_at": job.created_at, "started_at": job.started_at,
+        "finished_at": job.finished_at, "updated_at": job.updated_at,
+    }
+
+class JobManager:
+    """
+    Runs audits as background asyncio tasks, at most `max_running_jobs` at a time.
+    Progress is written to the audit_jobs table every `job_progress_interval` seconds (also
+    while queued or while listing yields nothing); a cancel requested through the table
+    (from any worker) is picked up on the next write. A job whose process died without
+    shutting down stops writing, and is treated as INTERRUPTED once its row is stale.
+    Rekognition work of all jobs shares pipeline.REKOGNITION_BUDGET.
+    Interrupted, failed or cancelled jobs can be resumed; the resumed run is incremental
+    so objects already audited at their current ETag are skipped.
+
+    Distributed jobs only list here: objects are enqueued in audit_work_items and any
+    number of worker.py processes claim and audit them. Such a job is LISTING while
+    its prefix is listed, RUNNING until the queue drains, then DONE (set by the workers).
+    """
+    def __init__(self, max_running_jobs: int, progress_interval: float):
+        self.progress_interval = progress_interval
+        self.stale_after = progress_interval * STALE_AFTER_INTERVALS
+        self._slots = asyncio.Semaphore(max_running_jobs)
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def submit(self, prefix: str, rule_ids: List[str], store_id: Optional[str] = None, incremental: bool = False,
+                     distributed: bool = False) -> str:
+        job_id = str(uuid.uuid4())
+        await create_job({"id": job_id, "prefix": prefix, "rule_ids": rule_ids, "store_id": store_id, "incremental": incremental,
+                          "distributed": distributed, "status": "QUEUED"})
+        self._start(job_id, prefix, rule_ids, store_id, incremental, distributed)
+        return job_id
+
+    async def recover(self) -> int:
+        """Mark jobs left QUEUED/RUNNING by a killed process as INTERRUPTED (called on startup)."""
+        n = await interrupt_stale_jobs(self.stale_after)
+        if n:
+            logger.warning("marked %d stale audit jobs INTERRUPTED", n)
+        return n
+
+    async def resume(self, job_id: str) -> Optional[dict]:
+        if job_id not in self._tasks:
+            await interrupt_stale_jobs(self.stale_after, job_id)
+        job = await get_job(job_id)
+        if job is None:
+            return None
+        if job.status in ("INTERRUPTED", "FAILED", "CANCELLED") and job_id not in self._tasks:
+            await update_job(job_id, {"status": "QUEUED", "cancel_requested": False, "error": None, "finished_at": None})
+            self._start(job_id, job.prefix, job.rule_ids, job.store_id, True, bool(job.distributed))
+            job = await get_job(job_id)
+        return await self._to_dict(job)
+
+    def _start(self, job_id: str, prefix: str, rule_ids: List[str], store_id: Optional[str], incremental: bool, distributed: bool = False):
+        run = self._run_distributed if distributed else self._run
+        task = asyncio.create_task(run(job_id, prefix, rule_ids, store_id, incremental))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = await get_job(job_id)
+        return await self._to_dict(job) if job else None
+
+    async def cancel(self, job_id: str) -> Optional[dict]:
+        job = await request_job_cancel(job_id)
+        if job is None:
+            return None
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        elif job.distributed and job.cancel_requested and job.status == "RUNNING":
+            # listing already finished; workers stop claiming its items, leased ones still complete
+            await update_job(job_id, {"status": "CANCELLED", "finished_at": datetime.utcnow()})
+            job = await get_job(job_id)
+        return await self._to_dict(job)
+
+    @staticmethod
+    async def _to_dict(job) -> dict:
+        return job_to_dict(job, await get_work_item_counts(job.id) if job.distributed else None)
+
+    async def shutdown(self):
+        """Stop local jobs on worker shutdown; they are left as INTERRUPTED."""
+        tasks = list(self._tasks.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _heartbeat(self, job_id: str, fields: Callable[[], dict], run: asyncio.Task):
+        """Write progress every interval (keeps updated_at fresh) and cancel the run when a cancel is requested."""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                if await update_job(job_id, fields()):
+                    run.cancel()
+                    return
+            except Exception:
+                logger.exception("progress write of job %s failed", job_id)
+
+    @staticmethod
+    async def _stop(heartbeat: asyncio.Task):
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _run(self, job_id: str, prefix: str, rule_ids: List[str], store_id: Optional[str], incremental: bool):
+        ctx = RunContext(rule_ids, store_id, run_id=job_id, incremental=incremental)
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, lambda: self._progress_fields(ctx), asyncio.current_task()))
+        try:
+            async with self._slots:
+                ctx.started = time.monotonic()
+                await update_job(job_id, {"status": "RUNNING", "started_at": datetime.utcnow()})
+                async for _ in stream_pipeline_for_prefix(prefix, ctx):
+                    pass
+            await self._stop(heartbeat)
+            await update_job(job_id, {**self._progress_fields(ctx), "status": "DONE", "finished_at": datetime.utcnow()})
+        except asyncio.CancelledError:
+            await self._stop(heartbeat)
+            job = await get_job(job_id)
+            status = "CANCELLED" if job is not None and job.cancel_requested else "INTERRUPTED"
+            await update_job(job_id, {**self._progress_fields(ctx), "status": status, "finished_at": datetime.utcnow()})
+        except Exception as e:
+            await self._stop(heartbeat)
+            logger.exception("audit job %s failed", job_id)
+            await update_job(job_id, {**self._progress_fields(ctx), "status": "FAILED", "error": str(e), "finished_at": datetime.utcnow()})
+
+    async def _run_distributed(self, job_id: str, prefix: str, rule_ids: List[str], store_id: Optional[str], incremental: bool):
+        ctx = RunContext(rule_ids, store_id, run_id=job_id, incremental=incremental)
+
+        def fields() -> dict:
+            return {"listed": ctx.listed, "skipped": ctx.skipped}
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, fields, asyncio.current_task()))
+        try:
+            await update_job(job_id, {"status": "LISTING", "started_at": datetime.utcnow()})
+            async for page in pending_object_pages(prefix, ctx):
+                await enqueue_work_items(job_id, [
+                    {"s3_key": o["Key"], "etag": o.get("ETag"), "last_modified": o.get("LastModified"), "size": o.get("Size"),
+                     "rule_ids": pending if pending != rule_ids else None}
+                    for o, pending in page])
+            await self._stop(heartbeat)
+            await update_job(job_id, {**fields(), "status": "RUNNING"})
+            await finish_drained_jobs([job_id])  # nothing enqueued, or the workers were faster than listing
+        except asyncio.CancelledError:
+            await self._stop(heartbeat)
+            job = await get_job(job_id)
+            status = "CANCELLED" if job is not None and job.cancel_requested else "INTERRUPTED"
+            await update_job(job_id, {**fields(), "status": status, "finished_at": datetime.utcnow()})
+        except Exception as e:
+            await self._stop(heartbeat)
+            logger.exception("listing of distributed job %s failed", job_id)
+            await update_job(job_id, {**fields(), "status": "FAILED", "error": str(e), "finished_at": datetime.utcnow()})
+
+    @staticmethod
+    def _progress_fields(ctx: RunContext) -> dict:
+        p = ctx.progress()
+        return {"listed": p["listed"], "skipped": p["skipped"], "processed": p["processed"], "failed": p["failed"], "images_per_s": p["images_per_s"]}
+
+job_manager = JobManager(settings.max_running_jobs, settings.job_progress_interval)
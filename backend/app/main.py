@@ -1,21 +1,40 @@
 # main.py
 import asyncio
-from fastapi import FastAPI, HTTPException
+import json
+import time
+from datetime import date, datetime
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from database import create_db_and_tables
-from pipeline import run_pipeline_for_prefix
-from rules_loader import load_rules
+from crud import get_compliance_summary, get_rekognition_raw, list_audits, list_images
+from s3_rek_client import start_clients, close_clients
+from rate_limiter import limiter_stats
+import metrics
+from image_utils import init_process_pool, shutdown_process_pool
+from jobs import job_manager
+from pipeline import RunContext, run_pipeline_for_prefix, stream_pipeline_for_prefix
+from rules_loader import select_rules
+from rule_engine import get_rules
 from config import settings
 
 app = FastAPI(title="Visual Audit Core Pipeline")
 
-# Load RULES on startup (optional)
-RULES = load_rules()
-
 @app.on_event("startup")
 async def startup_event():
     # create tables if not exist (safe to call)
     await create_db_and_tables()
+    get_rules()  # compile rules.json up front; later edits are picked up on the next request
+    await start_clients()
+    init_process_pool(settings.image_workers)
+    await job_manager.recover()  # jobs of a killed process become resumable
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_manager.shutdown()
+    await close_clients()
+    shutdown_process_pool()
 
 @app.get("/health")
 async def health():
@@ -23,27 +42,181 @@ async def health():
 
 class RunAuditRequest(BaseModel):
     prefix: str
-    rule_id: str
+    rule_id: str | None = None
+    rule_ids: list[str] | None = None
+    group: str | None = None
+    section: str | None = None
     store_id: str | None = None
+    background: bool = False  # enqueue as a job and return its id immediately
+    distributed: bool = False  # background job whose objects are audited by worker.py processes
+    incremental: bool = False  # skip objects already audited at their current ETag
+    skip_download: bool | None = None  # reuse pHash by ETag, Rekognition reads from S3 (default: settings)
+
+def _resolve_rule_ids(req: RunAuditRequest) -> list[str]:
+    rules = get_rules().raw
+    try:
+        rule_ids = select_rules(rules, ([req.rule_id] if req.rule_id else []) + (req.rule_ids or []), req.group, req.section)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"rule_id {e.args[0]} not found")
+    if not rule_ids:
+        raise HTTPException(status_code=400, detail="no rules selected; pass rule_id, rule_ids, group or section")
+    return rule_ids
 
 @app.post("/run_audit")
 async def run_audit(req: RunAuditRequest):
     """
-    Run pipeline for all objects in prefix and a given rule_id.
+    Run pipeline for all objects in prefix against one or more rules.
     prefix: S3 prefix like "store123/2025-09-11/"
-    rule_id: id of rule to evaluate (must exist in rules.json)
+    rule_id / rule_ids: ids of rules to evaluate (must exist in rules.json)
+    group / section: also evaluate every rule in that rules.json group/section
+    Each object is downloaded and sent to each Rekognition API once, whatever the rule count.
+    background: run as a job instead; poll GET /jobs/{job_id} for progress.
+    distributed: background job whose objects are queued for any number of worker.py processes.
+    incremental: only audit objects whose (s3_key, ETag, rule_id) has no audit row yet.
     """
-    # basic validation
-    rules = load_rules()
-    if req.rule_id not in rules:
-        raise HTTPException(status_code=400, detail=f"rule_id {req.rule_id} not found")
+    rule_ids = _resolve_rule_ids(req)
+    if req.background or req.distributed:
+        job_id = await job_manager.submit(req.prefix, rule_ids, req.store_id, req.incremental, req.distributed)
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": "QUEUED"})
 
     # call pipeline (this returns after processing the objects)
-    result = await run_pipeline_for_prefix(req.prefix, req.rule_id, req.store_id)
+    result = await run_pipeline_for_prefix(req.prefix, rule_ids, req.store_id, req.incremental, req.skip_download)
     return result
 
+async def _audit_events(req: RunAuditRequest, rule_ids: list[str]):
+    """(event, payload) pairs: start, one result per object, periodic progress, done."""
+    ctx = RunContext(rule_ids, req.store_id, incremental=req.incremental)
+    if req.skip_download is not None:
+        ctx.skip_download = req.skip_download
+    yield "start", {"run_id": ctx.run_id, "prefix": req.prefix, "rule_ids": rule_ids}
+    # the pipeline runs in its own task so progress keeps flowing on a timer even when no
+    # result arrives for a while (listing a large prefix, incremental runs skipping most objects)
+    results: asyncio.Queue = asyncio.Queue(maxsize=settings.queue_size)
+    end = object()
+
+    async def pump():
+        try:
+            async for result in stream_pipeline_for_prefix(req.prefix, ctx):
+                await results.put(result)
+        except Exception as e:
+            await results.put(e)
+            return
+        await results.put(end)
+
+    task = asyncio.create_task(pump())
+    last_progress = time.monotonic()
+    try:
+        while True:
+            timeout = settings.stream_progress_interval - (time.monotonic() - last_progress)
+            try:
+                item = await asyncio.wait_for(results.get(), timeout=max(timeout, 0.0))
+            except asyncio.TimeoutError:
+                item = None
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item is not None:
+                yield "result", item
+            if time.monotonic() - last_progress >= settings.stream_progress_interval:
+                last_progress = time.monotonic()
+                yield "progress", ctx.progress()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    yield "done", {**ctx.progress(), "rekognition_cache": ctx.cache_stats.as_dict(), "stage_timings": ctx.stage_timings()}
+
+@app.post("/run_audit/stream")
+async def run_audit_stream(req: RunAuditRequest, format: str = "ndjson"):
+    """
+    Same as /run_audit but streams each per-object result as soon as it is finished,
+    with periodic progress counters, instead of buffering one big JSON body.
+    format: "ndjson" (one {"event", "data"} object per line) or "sse" (Server-Sent Events).
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or sse")
+    rule_ids = _resolve_rule_ids(req)
+
+    async def body():
+        async for event, data in _audit_events(req, rule_ids):
+            if format == "sse":
+                yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+            else:
+                yield json.dumps({"event": event, "data": data}, default=str) + "\n"
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    """Restart an interrupted/failed/cancelled job incrementally, skipping objects it already audited."""
+    job = await job_manager.resume(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = await job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job
+
+@app.get("/audits")
+async def get_audits(store_id: Optional[str] = None, rule_id: Optional[str] = None, status: Optional[str] = None,
+                     run_id: Optional[str] = None, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None):
+    """Audit rows, newest first. Pass the returned next_cursor to get the following page."""
+    try:
+        rows, next_cursor = await list_audits(store_id, rule_id, status, run_id, since, until, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": rows, "next_cursor": next_cursor}
+
+@app.get("/images")
+async def get_images(store_id: Optional[str] = None, rule_id: Optional[str] = None, prefix: Optional[str] = None,
+                     is_repeated: Optional[bool] = None, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None):
+    """Image rows with their Rekognition summary, newest first (keyset pagination as in /audits); rule_id: audited under that rule."""
+    try:
+        rows, next_cursor = await list_images(store_id, rule_id, prefix, is_repeated, since, until, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": rows, "next_cursor": next_cursor}
+
+@app.get("/compliance/summary")
+async def compliance_summary(store_id: Optional[str] = None, rule_id: Optional[str] = None, since: Optional[date] = None,
+                             until: Optional[date] = None, by_day: bool = False):
+    """Pass rate and counts by status and reason code per store and rule (per day with by_day), from the daily rollups."""
+    return {"items": await get_compliance_summary(store_id, rule_id, since, until, by_day)}
+
+@app.get("/images/rekognition")
+async def image_rekognition_raw(s3_key: str):
+    """Full stored Rekognition responses for one image (loaded on demand; the images row only keeps a summary)."""
+    raw = await get_rekognition_raw(s3_key)
+    if raw is None:
+        raise HTTPException(status_code=404, detail=f"no Rekognition responses stored for {s3_key}")
+    return raw
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Prometheus text exposition: stage latency histograms, result/cache/throttle counters, in-flight gauges."""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/rekognition/limits")
+async def rekognition_limits():
+    """Current adaptive rate, in-flight calls and throttle counts per Rekognition API."""
+    return limiter_stats()
+
 @app.get("/sample_rules")
 async def sample_rules():
     # return loaded rule ids for quick check
-    rules = load_rules()
+    rules = get_rules().raw
     return {"count": len(rules), "rule_ids": list(rules.keys())}
@@ -0,0 +1,135 @@
+# metrics.py
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Minimal Prometheus text-format (0.0.4) metrics. Values are per process: with several
+# uvicorn workers each one serves its own /metrics, and Prometheus sums across targets.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()])
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in sorted(self._values.items())]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}  # per-bucket (non-cumulative) counts, +Inf last
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        out = []
+        for key in sorted(self._counts):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), self._counts[key]):
+                cumulative += n
+                le = 'le="%s"' % _fmt(bound)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(self._sums[key])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return out
+
+class GaugeCallback(_Metric):
+    """Gauge whose samples are read at scrape time from `fn() -> {label values tuple: value}`."""
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames, fn: Callable[[], Dict[Tuple[str, ...], float]]):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def samples(self):
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in sorted(self.fn().items())]
+
+REGISTRY: List[_Metric] = []
+
+def render() -> str:
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+# -------------------------
+# Audit pipeline metrics
+# -------------------------
+STAGE_SECONDS = Histogram("audit_stage_seconds", "Time one object spends in a pipeline stage.", ["stage"])
+STAGE_IN_FLIGHT = Gauge("audit_stage_in_flight", "Objects currently being processed by a pipeline stage.", ["stage"])
+RESULTS = Counter("audit_results_total", "Audited objects by overall status.", ["status"])
+REKOGNITION_BUDGET_WAIT = Histogram("audit_rekognition_budget_wait_seconds", "Time waiting for the process-wide Rekognition budget semaphore.",
+                                    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+CACHE_LOOKUPS = Counter("rekognition_cache_lookups_total", "Rekognition response cache lookups.", ["api", "result"])
+REKOGNITION_CALLS = Counter("rekognition_calls_total", "Rekognition API attempts (including retries).", ["api"])
+REKOGNITION_THROTTLES = Counter("rekognition_throttles_total", "Rekognition calls rejected with a throttling error.", ["api"])
+REKOGNITION_ERRORS = Counter("rekognition_errors_total", "Rekognition calls failed with a non-throttling error.", ["api"])
+DB_FLUSH_SECONDS = Histogram("audit_db_flush_seconds", "Duration of one write-behind batch transaction.")
+DB_ROWS = Counter("audit_db_rows_total", "Rows written by write-behind flushes.", ["table"])
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, JSON, Text, func
+from sqlalchemy import Column, BigInteger, Integer, String, Date, DateTime, Boolean, JSON, Text, Float, Index, LargeBinary, SmallInteger, func
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import deferred
 from database import Base
 
 class Image(Base):
@@ -7,21 +8,145 @@ class Image(Base):
     id = Column(Integer, primary_key=True)
     s3_key = Column(String, unique=True, nullable=False, index=True)
     file_url = Column(String)
-    rule_id = Column(String, index=True)
+    rule_id = Column(String, index=True)  # set by single-rule runs; every rule is in image_rules
     store_id = Column(String, index=True)
     captured_at = Column(DateTime, nullable=True)
     processed_at = Column(DateTime, server_default=func.now())
     phash = Column(String, index=True)
-    rekognition_json = Column(JSONB, nullable=True)
+    phash_bits = Column(LargeBinary, nullable=True)  # same hash as fixed-width binary (32 bytes for hash_size=16)
+    etag = Column(String, index=True)  # S3 ETag of the processed version (pHash cache key)
+    rekognition_summary = Column(JSONB, nullable=True)  # {"labels": [{name, confidence}], "text": [tokens], "face_count": n}
+    # legacy rows only: full responses now live in image_rekognition_raw; not loaded unless accessed
+    rekognition_json = deferred(Column(JSONB, nullable=True))
     face_count = Column(Integer, nullable=True)
     is_repeated = Column(Boolean, default=False)
 
+    # GET /images: newest first, keyset on (processed_at, id), optionally per store
+    __table_args__ = (
+        Index("ix_images_store_time", "store_id", "processed_at", "id"),
+        Index("ix_images_time", "processed_at", "id"),
+    )
+
+class ImageRule(Base):
+    """Rules an image has been audited under (images.rule_id only holds the rule of single-rule runs)."""
+    __tablename__ = "image_rules"
+    s3_key = Column(String, primary_key=True)
+    rule_id = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_image_rules_rule_key", "rule_id", "s3_key"),)
+
+class ImageRekognitionRaw(Base):
+    """Full Rekognition responses of an image (zlib-compressed JSON), read only on demand."""
+    __tablename__ = "image_rekognition_raw"
+    s3_key = Column(String, primary_key=True)
+    etag = Column(String, nullable=True)
+    payload = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, server_default=func.now())
+
+class PhashChunk(Base):
+    """
+    images.phash split into 16-bit chunks for near-duplicate candidate lookup: two hashes
+    within d < PHASH_CHUNKS bits share at least one chunk exactly (pigeonhole principle).
+    """
+    __tablename__ = "image_phash_chunks"
+    s3_key = Column(String, primary_key=True)
+    chunk_no = Column(SmallInteger, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_phash_chunks_chunk_value", "chunk_no", "value"),)
+
 class Audit(Base):
     __tablename__ = "audits"
     id = Column(Integer, primary_key=True)
     run_id = Column(String, index=True)
     rule_id = Column(String, index=True)
+    store_id = Column(String, nullable=True)
     s3_key = Column(String, index=True)
     status = Column(String)
     reason = Column(Text, nullable=True)
     processed_at = Column(DateTime, server_default=func.now())
+    # watermark of the object version that was audited (incremental runs skip it next time)
+    etag = Column(String, nullable=True)
+    object_last_modified = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_audits_key_rule_etag", "s3_key", "rule_id", "etag"),
+        # GET /audits filters (store, rule, status, time range), newest first with keyset on (processed_at, id)
+        Index("ix_audits_store_rule_status_time", "store_id", "rule_id", "status", "processed_at", "id"),
+        Index("ix_audits_rule_status_time", "rule_id", "status", "processed_at", "id"),
+        Index("ix_audits_time", "processed_at", "id"),
+    )
+
+class AuditDailyStatus(Base):
+    """Audit counts per day/store/rule/status, maintained in the same transaction as the audit inserts."""
+    __tablename__ = "audit_daily_status"
+    day = Column(Date, primary_key=True)
+    store_id = Column(String, primary_key=True)  # "" when the run had no store
+    rule_id = Column(String, primary_key=True)
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_audit_daily_status_store_day", "store_id", "day"),)
+
+class AuditDailyReason(Base):
+    """
+    Audit counts per day/store/rule/reason code. A combined reason ("labels_missing|REPEATED")
+    counts once under each code, so these do not sum to the status totals.
+    """
+    __tablename__ = "audit_daily_reasons"
+    day = Column(Date, primary_key=True)
+    store_id = Column(String, primary_key=True)
+    rule_id = Column(String, primary_key=True)
+    reason = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_audit_daily_reasons_store_day", "store_id", "day"),)
+
+class AuditJob(Base):
+    __tablename__ = "audit_jobs"
+    id = Column(String, primary_key=True)  # also the run_id of the job's audits
+    prefix = Column(String, nullable=False)
+    rule_ids = Column(JSONB, nullable=False)
+    store_id = Column(String, nullable=True)
+    incremental = Column(Boolean, default=False)
+    distributed = Column(Boolean, default=False)  # objects go to audit_work_items and are processed by worker.py
+    status = Column(String, index=True)  # QUEUED / LISTING / RUNNING / DONE / FAILED / CANCELLED / INTERRUPTED
+    listed = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    processed = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    images_per_s = Column(Float, nullable=True)
+    cancel_requested = Column(Boolean, default=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class WorkItem(Base):
+    """
+    One object of a distributed job. Workers claim PENDING (or lease-expired) items with
+    FOR UPDATE SKIP LOCKED and mark them DONE after their audits are written.
+    """
+    __tablename__ = "audit_work_items"
+    id = Column(BigInteger, primary_key=True)
+    job_id = Column(String, nullable=False)
+    s3_key = Column(String, nullable=False)
+    etag = Column(String, nullable=True)
+    last_modified = Column(DateTime, nullable=True)
+    size = Column(BigInteger, nullable=True)
+    rule_ids = Column(JSONB, nullable=True)  # rules still pending for the object; None = all of the job's rules
+    status = Column(String, nullable=False, default="PENDING")  # PENDING / LEASED / DONE / FAILED
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+    result_status = Column(String, nullable=True)  # overall audit status of the object
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ux_work_items_job_key", "job_id", "s3_key", unique=True),
+        Index("ix_work_items_claim", "status", "lease_until", "id"),
+        Index("ix_work_items_job_status", "job_id", "status"),
+    )
@@ -0,0 +1,91 @@
+# persistence.py
+import asyncio
+import logging
+from typing import Dict, Any, List
+from crud import write_batch
+from metrics import DB_FLUSH_SECONDS, DB_ROWS
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindBatcher:
+    """
+    Collects image and audit records and writes them with crud.write_batch, either
+    when `batch_size` records are pending or every `flush_interval` seconds.
+
+    Usage:
+        async with WriteBehindBatcher(500, 1.0) as batcher:
+            await batcher.add_image(record)
+            await batcher.add_audit(audit)
+    """
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._images: List[Dict[str, Any]] = []
+        self._audits: List[Dict[str, Any]] = []
+        self._flush_lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._images) + len(self._audits)
+
+    async def start(self):
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+            self._timer = None
+        await self.flush()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def add_image(self, record: Dict[str, Any]):
+        self._images.append(record)
+        await self._maybe_flush()
+
+    async def add_audit(self, audit: Dict[str, Any]):
+        self._audits.append(audit)
+        await self._maybe_flush()
+
+    async def _maybe_flush(self):
+        if self.pending >= self.batch_size:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed; %d records pending", self.pending)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            images, self._images = self._images, []
+            audits, self._audits = self._audits, []
+            try:
+                with DB_FLUSH_SECONDS.time():
+                    await write_batch(images, audits)
+            except Exception:
+                # keep the records so the next flush (or close) retries them
+                self._images[:0] = images
+                self._audits[:0] = audits
+                raise
+            DB_ROWS.inc(len(images), table="images")
+            DB_ROWS.inc(len(audits), table="audits")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed; %d records pending", self.pending)
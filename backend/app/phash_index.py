@@ -0,0 +1,169 @@
+# phash_index.py
+import asyncio
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+import numpy as np
+from crud import PHASH_CHUNKS, find_phash_match, get_recent_images_phashes
+
+logger = logging.getLogger(__name__)
+
+Phash = Union[str, bytes]  # hex string (images.phash) or fixed-width binary (images.phash_bits)
+
+class PhashMatch(NamedTuple):
+    s3_key: str
+    distance: int
+
+def dedup_prefix(s3_key: str) -> str:
+    """
+    Prefix that near-duplicates are searched under, e.g.
+    "audit-data/store123/CRE/2025-09-08/1.jpg" -> "audit-data/store123/CRE/".
+    """
+    return s3_key.rsplit("/", 2)[0] + "/"
+
+def phash_words(phash: Phash) -> np.ndarray:
+    """pHash as a row of uint64 words (a 256-bit hash -> 4 words)."""
+    raw = bytes.fromhex(phash) if isinstance(phash, str) else phash
+    return np.frombuffer(raw, dtype=np.uint64)
+
+if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+    def _popcount_rows(x: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.int64)
+else:
+    _POPCOUNT_U8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    def _popcount_rows(x: np.ndarray) -> np.ndarray:
+        return _POPCOUNT_U8[x.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+# -------------------------
+# Contiguous hash matrix with vectorized Hamming search
+# -------------------------
+class PhashMatrix:
+    """
+    All hashes of an index in one contiguous (n, words) uint64 array. A query is a single
+    XOR + popcount over the whole array; match_many does the same for a batch of queries.
+    """
+    _QUERY_CHUNK_BYTES = 64 * 1024 * 1024  # cap on the (queries, n, words) XOR temporary
+
+    def __init__(self, words: int = 4, capacity: int = 1024):
+        self.words = words
+        self._data = np.empty((capacity, words), dtype=np.uint64)
+        self._n = 0
+        self.keys: List[str] = []
+
+    def __len__(self):
+        return self._n
+
+    def add(self, s3_key: str, words: np.ndarray):
+        if words.shape != (self.words,):
+            return  # different hash_size; not comparable
+        if self._n == len(self._data):
+            self._data = np.concatenate([self._data, np.empty_like(self._data)])
+        self._data[self._n] = words
+        self._n += 1
+        self.keys.append(s3_key)
+
+    def distances(self, words: np.ndarray) -> np.ndarray:
+        return _popcount_rows(self._data[:self._n] ^ words)
+
+    def match_many(self, queries: np.ndarray, radius: int) -> List[List[PhashMatch]]:
+        """For each row of `queries` (m, words), every stored hash within `radius` bits."""
+        out: List[List[PhashMatch]] = []
+        if self._n == 0:
+            return [[] for _ in range(len(queries))]
+        data = self._data[:self._n]
+        step = max(1, self._QUERY_CHUNK_BYTES // max(1, data.nbytes))
+        for i in range(0, len(queries), step):
+            d = _popcount_rows(queries[i:i + step, None, :] ^ data[None, :, :])
+            for row in d:
+                hits = np.flatnonzero(row <= radius)
+                out.append([PhashMatch(self.keys[j], int(row[j])) for j in hits])
+        return out
+
+# -------------------------
+# Per-prefix index
+# -------------------------
+class PhashIndex:
+    """Near-duplicate index over the pHashes of a single store prefix."""
+    def __init__(self):
+        self._matrix: Optional[PhashMatrix] = None
+
+    def __len__(self):
+        return len(self._matrix) if self._matrix else 0
+
+    def add(self, s3_key: str, phash: Optional[Phash]):
+        if not phash:
+            return
+        words = phash_words(phash)
+        if self._matrix is None:
+            self._matrix = PhashMatrix(len(words))
+        self._matrix.add(s3_key, words)
+
+    def nearest(self, phash: Optional[Phash], radius: int, exclude_key: str = None) -> Optional[PhashMatch]:
+        """
+        Closest stored hash within `radius` bits of `phash`, or None.
+        `exclude_key` skips the object's own earlier hash so re-runs don't flag themselves.
+        """
+        if not phash or self._matrix is None:
+            return None
+        return self.nearest_many([phash], radius, [exclude_key])[0]
+
+    def nearest_many(self, phashes: Sequence[Optional[Phash]], radius: int,
+                     exclude_keys: Sequence[Optional[str]] = None) -> List[Optional[PhashMatch]]:
+        """Batch form of nearest(): one vectorized pass for all query hashes."""
+        results: List[Optional[PhashMatch]] = [None] * len(phashes)
+        if self._matrix is None:
+            return results
+        rows = [i for i, p in enumerate(phashes) if p and len(phash_words(p)) == self._matrix.words]
+        if not rows:
+            return results
+        queries = np.stack([phash_words(phashes[i]) for i in rows])
+        for i, matches in zip(rows, self._matrix.match_many(queries, radius)):
+            exclude = exclude_keys[i] if exclude_keys else None
+            best = min((m for m in matches if m.s3_key != exclude), key=lambda m: m.distance, default=None)
+            results[i] = best
+        return results
+
+class PhashIndexRegistry:
+    """
+    One PhashIndex per dedup prefix, kept up to date as objects are processed.
+    backend="memory": the index is loaded from the DB the first time the prefix is seen
+    during a run. backend="database": earlier images are searched in Postgres per lookup
+    (crud.find_phash_match), and the in-memory index only holds this run's images, which
+    may not have been flushed yet. backend="local": this run's images only (no DB).
+    prefix_for maps an object key to its dedup scope (default dedup_prefix).
+    """
+    def __init__(self, days: int, backend: str = "memory", prefix_for: Callable[[str], str] = dedup_prefix):
+        self.days = days
+        self.backend = backend
+        self.prefix_for = prefix_for
+        self._indexes: Dict[str, PhashIndex] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._warned = False
+
+    async def get(self, prefix: str) -> PhashIndex:
+        index = self._indexes.get(prefix)
+        if index is not None:
+            return index
+        lock = self._locks.setdefault(prefix, asyncio.Lock())
+        async with lock:
+            if prefix not in self._indexes:
+                index = PhashIndex()
+                if self.backend == "memory":
+                    for s3_key, phash in await get_recent_images_phashes(prefix, self.days):
+                        index.add(s3_key, phash)
+                self._indexes[prefix] = index
+        return self._indexes[prefix]
+
+    async def nearest(self, s3_key: str, phash: Optional[str], radius: int) -> Optional[PhashMatch]:
+        """Closest earlier image within `radius` bits of `phash`; then records this one."""
+        prefix = self.prefix_for(s3_key)
+        index = await self.get(prefix)
+        match = index.nearest(phash, radius, exclude_key=s3_key)
+        if self.backend == "database" and phash:
+            if radius >= PHASH_CHUNKS and not self._warned:
+                self._warned = True
+                logger.warning("phash radius %d >= %d chunks: database candidate search can miss matches", radius, PHASH_CHUNKS)
+            row = await find_phash_match(prefix, phash, radius, self.days, exclude_key=s3_key)
+            if row is not None and (match is None or row[1] < match.distance):
+                match = PhashMatch(*row)
+        index.add(s3_key, phash)
+        return match
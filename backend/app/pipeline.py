@@ -1,90 +1,362 @@
-import asyncio, uuid
+import asyncio, contextlib, time, uuid
+from dataclasses import dataclass, field
 from datetime import datetime
-from s3_rek_client import list_objects, get_object_bytes, detect_faces_bytes, detect_labels_bytes, detect_text_bytes
-from image_utils import compute_phash, phash_hamming_distance
-from crud import upsert_image_record, insert_audit, get_recent_images_phashes
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from s3_rek_client import (iter_object_pages, get_object_bytes, detect_faces_bytes, detect_labels_bytes, detect_text_bytes,
+                           detect_faces_s3, detect_labels_s3, detect_text_s3)
+from image_utils import phash_to_bytes, prepare_image, run_in_pool
+from persistence import WriteBehindBatcher
+from crud import get_audited_versions, get_phashes_by_etag
+from phash_index import PhashIndexRegistry, PhashMatch
+from rek_cache import CacheStats, content_id_for_digest, content_id_for_etag, start_run_stats
 from config import settings
-from rules_loader import load_rules
+from rule_engine import Detections, get_rules
+from metrics import RESULTS, REKOGNITION_BUDGET_WAIT, STAGE_IN_FLIGHT, STAGE_SECONDS
 
-RULES = load_rules()
+# process-wide cap on in-flight Rekognition work, shared by every run and background job
+REKOGNITION_BUDGET = asyncio.Semaphore(settings.global_concurrency)
+# severity used to pick the overall status of an object audited against several rules
+_STATUS_ORDER = {"PASS": 0, "REVIEW": 1, "FAIL": 2, "ERROR": 3}
 
-async def _process_object(obj, rule_id, store_id, semaphore):
-    async with semaphore:
-        s3_key = obj["Key"]
-        run_id = str(uuid.uuid4())
-        processed_at = datetime.utcnow().isoformat()
+async def _call_rekognition(bytes_img: Optional[bytes], content_id: str, calls: Dict[str, dict], s3_key: str = None, etag: str = None) -> Dict[str, dict]:
+    """Uses the *_bytes wrappers, or the S3Object ones (keyed by ETag) when the image wasn't downloaded."""
+    coros = {}
+    if bytes_img is None:
+        bucket = settings.s3_bucket
+        if "faces" in calls:
+            coros["faces"] = detect_faces_s3(bucket, s3_key, etag=etag)
+        if "text" in calls:
+            coros["text"] = detect_text_s3(bucket, s3_key, etag=etag)
+        if "labels" in calls:
+            coros["labels"] = detect_labels_s3(bucket, s3_key, etag=etag, **calls["labels"])
+    else:
+        if "faces" in calls:
+            coros["faces"] = detect_faces_bytes(bytes_img, content_id=content_id)
+        if "text" in calls:
+            coros["text"] = detect_text_bytes(bytes_img, content_id=content_id)
+        if "labels" in calls:
+            coros["labels"] = detect_labels_bytes(bytes_img, content_id=content_id, **calls["labels"])
+    resps = await asyncio.gather(*coros.values())
+    return dict(zip(coros.keys(), resps))
 
-        try:
-            bytes_img = await get_object_bytes(s3_key)
-        except Exception as e:
-            await insert_audit({"run_id": run_id, "rule_id": rule_id, "s3_key": s3_key, "status": "ERROR", "reason": f"download_error:{e}", "processed_at": processed_at})
-            return {"s3_key": s3_key, "status": "ERROR", "reason": str(e)}
-
-        # phash
-        try: phash = compute_phash(bytes_img)
-        except: phash = None
-
-        # duplicates
-        recent_phashes = await get_recent_images_phashes(s3_key.rsplit("/", 2)[0]+"/", settings.recent_days)
-        is_repeated = False
-        if phash and recent_phashes:
-            for old in recent_phashes:
-                if phash_hamming_distance(phash, old) <= settings.phash_hamming_threshold:
-                    is_repeated = True
-                    break
+# -------------------------
+# Run state
+# -------------------------
+@dataclass
+class RunContext:
+    """State shared by every object of one pipeline run."""
+    rule_ids: List[str]
+    store_id: Optional[str] = None
+    run_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    phash_indexes: PhashIndexRegistry = field(default_factory=lambda: PhashIndexRegistry(settings.recent_days, settings.dedup_backend))
+    incremental: bool = False  # skip (s3_key, ETag, rule_id) that already has an audit row
+    # reuse pHash by ETag and let Rekognition read from S3; download only on a miss
+    skip_download: bool = field(default_factory=lambda: settings.skip_download)
+    # where object bytes come from (S3 by default; cli.py reads local files) and whether
+    # image/audit records are written to the DB
+    read_object: Callable[[str], Awaitable[bytes]] = get_object_bytes
+    persist: bool = True
+    batcher: Optional[WriteBehindBatcher] = None
+    cache_stats: Optional[CacheStats] = None
+    listed: int = 0
+    skipped: int = 0
+    processed: int = 0
+    failed: int = 0
+    downloads_skipped: int = 0
+    status_counts: Dict[str, int] = field(default_factory=dict)
+    stage_stats: Dict[str, List[float]] = field(default_factory=dict)  # stage -> [count, total_s, max_s]
+    started: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self):
+        # snapshot of the compiled rules; a hot reload mid-run doesn't change this run
+        self.ruleset = get_rules()
+        self.calls = self.ruleset.plan_calls(self.rule_ids)
+        self._subset_calls: Dict[tuple, Dict[str, dict]] = {}
+
+    def calls_for(self, rule_ids: List[str]) -> Dict[str, dict]:
+        """Rekognition call plan for a subset of the run's rules (incremental runs)."""
+        if rule_ids == self.rule_ids:
+            return self.calls
+        key = tuple(rule_ids)
+        if key not in self._subset_calls:
+            self._subset_calls[key] = self.ruleset.plan_calls(rule_ids)
+        return self._subset_calls[key]
+
+    def record(self, result: dict):
+        self.processed += 1
+        if result["status"] == "ERROR":
+            self.failed += 1
+        self.status_counts[result["status"]] = self.status_counts.get(result["status"], 0) + 1
+        RESULTS.inc(status=result["status"])
+
+    def record_stage(self, name: str, seconds: float):
+        s = self.stage_stats.setdefault(name, [0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += seconds
+        s[2] = max(s[2], seconds)
+
+    def stage_timings(self) -> Dict[str, dict]:
+        """Per-stage breakdown for the run: objects, total/mean/max seconds."""
+        return {name: {"count": n, "total_s": round(total, 3), "mean_ms": round(1000 * total / n, 3), "max_ms": round(1000 * mx, 3)}
+                for name, (n, total, mx) in self.stage_stats.items()}
+
+    def progress(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {"run_id": self.run_id, "listed": self.listed, "skipped": self.skipped, "processed": self.processed, "failed": self.failed,
+                "downloads_skipped": self.downloads_skipped, "status_counts": dict(self.status_counts), "elapsed_s": round(elapsed, 3),
+                "images_per_s": round(self.processed / elapsed, 3) if elapsed > 0 else None}
+
+@dataclass
+class _Item:
+    """One object moving through the stages; `result` is set once it is finished or failed."""
+    obj: dict
+    rule_ids: List[str]  # rules still to evaluate for this object
+    processed_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
+    bytes_img: Optional[bytes] = None
+    content_id: Optional[str] = None
+    phash: Optional[str] = None
+    phash_looked_up: bool = False  # ETag -> pHash cache already consulted (skip_download runs)
+    match: Optional[PhashMatch] = None
+    result: Optional[dict] = None
+    image_record: Optional[dict] = None
+    audits: List[dict] = field(default_factory=list)
 
-        # rule
-        rule = RULES.get(rule_id)
-        rek_resp = {}
-        face_count = None
-        status = "REVIEW"
-        reason = None
+    @property
+    def s3_key(self) -> str:
+        return self.obj["Key"]
 
+    def audit(self, ctx: "RunContext", rule_id: str, status: str, reason: Optional[str]) -> dict:
+        return {"run_id": ctx.run_id, "rule_id": rule_id, "store_id": ctx.store_id, "s3_key": self.s3_key, "status": status, "reason": reason,
+                "processed_at": self.processed_at, "etag": self.obj.get("ETag"), "object_last_modified": self.obj.get("LastModified")}
+
+def _fail(item: _Item, ctx: RunContext, reason: str):
+    item.bytes_img = None
+    item.audits = [item.audit(ctx, rule_id, "ERROR", reason) for rule_id in item.rule_ids]
+    item.result = {"s3_key": item.s3_key, "status": "ERROR", "reason": reason}
+
+# -------------------------
+# Stages: download -> hash -> dedup -> rekognition -> persist
+# -------------------------
+async def _download(item: _Item, ctx: RunContext):
+    etag = item.obj.get("ETag")
+    if ctx.skip_download and etag:
+        if not item.phash_looked_up:
+            item.phash = (await get_phashes_by_etag([etag])).get(etag)
+            item.phash_looked_up = True
+        if item.phash is not None:
+            # known content: Rekognition reads the object from S3 directly
+            item.content_id = content_id_for_etag(etag)
+            ctx.downloads_skipped += 1
+            return
+    item.bytes_img = await ctx.read_object(item.s3_key)
+
+async def _hash(item: _Item, ctx: RunContext):
+    if item.bytes_img is None:
+        return
+    # sha256 + one reduced-scale decode for the pHash and the Rekognition upload, in the image process pool
+    digest, item.phash, upload = await run_in_pool(
+        prepare_image, item.bytes_img, 16, settings.rekognition_max_upload_bytes, settings.rekognition_max_dimension)
+    item.content_id = content_id_for_digest(digest)
+    if upload is not None:
+        item.bytes_img = upload
+
+async def _dedup(item: _Item, ctx: RunContext):
+    # memory backend: index loaded once per prefix per run; database backend: indexed lookup per image
+    item.match = await ctx.phash_indexes.nearest(item.s3_key, item.phash, settings.phash_hamming_threshold)
+
+async def _rekognize(item: _Item, ctx: RunContext):
+    # one Rekognition call per API, shared by every rule that needs it
+    t0 = time.perf_counter()
+    async with REKOGNITION_BUDGET:
+        wait = time.perf_counter() - t0
+        REKOGNITION_BUDGET_WAIT.observe(wait)
+        ctx.record_stage("rekognition_budget_wait", wait)
+        responses = await _call_rekognition(item.bytes_img, item.content_id, ctx.calls_for(item.rule_ids), item.s3_key, item.obj.get("ETag"))
+    item.bytes_img = None
+    face_count = len(responses["faces"].get("FaceDetails", [])) if "faces" in responses else None
+    is_repeated = item.match is not None
+
+    det = Detections(responses)
+    rule_results = {}
+    for rule_id in item.rule_ids:
+        rule = ctx.ruleset.get(rule_id)
         if not rule:
-            status = "REVIEW"
-            reason = "no_rule_found"
+            status, reason = "REVIEW", "no_rule_found"
         else:
-            rtype = rule.get("visual_audit_type")
-            if rtype == "FaceCount":
-                rf = await detect_faces_bytes(bytes_img)
-                face_count = len(rf.get("FaceDetails", []))
-                rek_resp = rf
-                if face_count >= rule.get("min_faces", 1): status="PASS"
-                else: status="FAIL"; reason=f"face_count_{face_count}_lt_{rule.get('min_faces')}"
-            elif rtype == "TextMatch":
-                rt = await detect_text_bytes(bytes_img)
-                texts = [t.get("DetectedText","").upper() for t in rt.get("TextDetections",[])]
-                rek_resp = rt
-                expected = rule.get("expected_text","").upper()
-                if expected in " ".join(texts): status="PASS"
-                else: status="FAIL"; reason=f"text_not_found_{expected}"
-            elif rtype == "LabelCheck":
-                rl = await detect_labels_bytes(bytes_img)
-                labels = [l.get("Name") for l in rl.get("Labels",[])]
-                rek_resp = rl
-                expected = rule.get("expected_labels", [])
-                if all(e in labels for e in expected): status="PASS"
-                else: status="FAIL"; reason="labels_missing"
-            else:
-                status="REVIEW"; reason=f"unsupported_rule_type_{rtype}"
-
+            status, reason = rule.evaluate(det)
         if is_repeated:
             reason = (reason + "|REPEATED") if reason else "REPEATED"
             status="FAIL"
+        rule_results[rule_id] = {"status": status, "reason": reason}
 
-        # save
-        record = {"s3_key": s3_key, "file_url": f"s3://{settings.s3_bucket}/{s3_key}", "rule_id": rule_id, "store_id": store_id, "captured_at": obj.get("LastModified").isoformat() if obj.get("LastModified") else None, "processed_at": processed_at, "phash": phash, "rekognition_json": rek_resp, "face_count": face_count, "is_repeated": is_repeated}
-        await upsert_image_record(record)
+    obj, s3_key, match = item.obj, item.s3_key, item.match
+    item.image_record = {"s3_key": s3_key, "file_url": f"s3://{settings.s3_bucket}/{s3_key}", "rule_id": item.rule_ids[0] if len(item.rule_ids) == 1 else None, "rule_ids": item.rule_ids, "store_id": ctx.store_id, "captured_at": obj.get("LastModified").isoformat() if obj.get("LastModified") else None, "processed_at": item.processed_at, "phash": item.phash, "phash_bits": phash_to_bytes(item.phash), "etag": obj.get("ETag"), "rekognition_summary": det.summary(), "rekognition_raw": responses, "face_count": face_count, "is_repeated": is_repeated}
+    item.audits = [item.audit(ctx, rule_id, r["status"], r["reason"]) for rule_id, r in rule_results.items()]
 
-        await insert_audit({"run_id": run_id, "rule_id": rule_id, "s3_key": s3_key, "status": status, "reason": reason, "processed_at": processed_at})
-        return {"s3_key": s3_key, "status": status, "reason": reason, "is_repeated": is_repeated}
+    overall = max((r["status"] for r in rule_results.values()), key=_STATUS_ORDER.get)
+    single = rule_results[item.rule_ids[0]] if len(item.rule_ids) == 1 else None
+    item.result = {"s3_key": s3_key, "status": overall, "reason": single["reason"] if single else None, "rules": rule_results,
+                   "is_repeated": is_repeated, "repeated_of": match.s3_key if match else None, "repeat_distance": match.distance if match else None}
 
-async def run_pipeline_for_prefix(prefix: str, rule_id: str, store_id: str = None):
-    objs = await list_objects(prefix)
+async def _persist(item: _Item, ctx: RunContext):
+    if ctx.batcher is None:
+        return
+    if item.image_record is not None:
+        await ctx.batcher.add_image(item.image_record)
+    for audit in item.audits:
+        await ctx.batcher.add_audit(audit)
+
+def _stages():
+    """(name, fn, worker count) for each stage, in order."""
+    return [
+        ("download", _download, settings.download_workers),
+        ("hash", _hash, settings.hash_workers),
+        ("dedup", _dedup, 1),
+        ("rekognition", _rekognize, settings.concurrency),
+        ("persist", _persist, 1),
+    ]
+
+async def _apply(name: str, fn, item: _Item, ctx: RunContext):
+    # failed items skip the remaining work but still reach persist so their ERROR audits are written
+    if item.result is not None and name != "persist":
+        return
+    STAGE_IN_FLIGHT.inc(stage=name)
+    t0 = time.perf_counter()
+    try:
+        await fn(item, ctx)
+    except Exception as e:
+        _fail(item, ctx, f"{name}_error:{e}")
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_IN_FLIGHT.dec(stage=name)
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        ctx.record_stage(name, elapsed)
+
+async def _process_object(obj, ctx: RunContext, rule_ids: Optional[List[str]] = None) -> dict:
+    """Run a single object through every stage in sequence (ctx.batcher must be open)."""
+    item = _Item(obj, rule_ids or ctx.rule_ids)
+    for name, fn, _ in _stages():
+        await _apply(name, fn, item, ctx)
+    return item.result
+
+# -------------------------
+# Streaming runner
+# -------------------------
+_DONE = object()
+
+async def _pending_rules(page: List[dict], ctx: RunContext) -> List[List[str]]:
+    """Rules each object still needs; incremental runs drop rules already audited at the object's ETag."""
+    if not ctx.incremental:
+        return [ctx.rule_ids] * len(page)
+    done = await get_audited_versions([o["Key"] for o in page], ctx.rule_ids)
+    return [[rid for rid in ctx.rule_ids if (o["Key"], rid, o.get("ETag")) not in done] for o in page]
+
+async def _known_phashes(page: List[dict], ctx: RunContext) -> Optional[Dict[str, str]]:
+    """ETag -> pHash for a listing page (one query) when running with skip_download."""
+    if not ctx.skip_download:
+        return None
+    return await get_phashes_by_etag([o["ETag"] for o in page if o.get("ETag")])
+
+async def _recent_object_pages(prefix: str) -> AsyncIterator[List[dict]]:
     cutoff_ts = datetime.utcnow().timestamp() - (settings.recent_days*24*3600)
-    objs_recent = [o for o in objs if o.get("LastModified") and o["LastModified"].timestamp() >= cutoff_ts]
+    async for page in iter_object_pages(prefix):
+        yield [o for o in page if o.get("LastModified") and o["LastModified"].timestamp() >= cutoff_ts]
+
+async def pending_object_pages(prefix: str, ctx: RunContext) -> AsyncIterator[List[Tuple[dict, List[str]]]]:
+    """Recent objects under prefix with the rules each still needs; counts ctx.listed/skipped."""
+    async for page in _recent_object_pages(prefix):
+        ctx.listed += len(page)
+        pending = []
+        for o, rule_ids in zip(page, await _pending_rules(page, ctx)):
+            if rule_ids:
+                pending.append((o, rule_ids))
+            else:
+                ctx.skipped += 1
+        yield pending
+
+async def _produce(pages: AsyncIterator[List[dict]], ctx: RunContext, outbox: asyncio.Queue):
+    async for page in pages:
+        ctx.listed += len(page)
+        known = await _known_phashes(page, ctx)
+        for o, rule_ids in zip(page, await _pending_rules(page, ctx)):
+            if not rule_ids:
+                ctx.skipped += 1
+                continue
+            item = _Item(o, rule_ids)
+            if known is not None:
+                item.phash, item.phash_looked_up = known.get(o.get("ETag")), True
+            await outbox.put(item)
+    await outbox.put(_DONE)
+
+async def _run_stage(name: str, fn, workers: int, ctx: RunContext, inbox: asyncio.Queue, outbox: asyncio.Queue):
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                await inbox.put(_DONE)  # let sibling workers see it too
+                return
+            await _apply(name, fn, item, ctx)
+            await outbox.put(item)
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    await outbox.put(_DONE)
+
+async def _next_output(outbox: asyncio.Queue, tasks: List[asyncio.Task]):
+    """Next finished item, re-raising if listing or a stage dies instead of hanging."""
+    getter = asyncio.ensure_future(outbox.get())
+    pending = {getter, *tasks}
+    while True:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            return getter.result()
+        for t in done:
+            if t is not getter and t.exception() is not None:
+                getter.cancel()
+                raise t.exception()
+
+async def stream_pipeline_for_prefix(prefix: str, ctx: RunContext) -> AsyncIterator[dict]:
+    """
+    Yield per-object results as they finish. Listing feeds bounded queues between the
+    stages, so work starts after the first page and memory stays flat for any prefix size.
+    """
+    async for result in stream_pipeline(_recent_object_pages(prefix), ctx):
+        yield result
+
+async def stream_pipeline(pages: AsyncIterator[List[dict]], ctx: RunContext) -> AsyncIterator[dict]:
+    """Run objects from `pages` (lists of {"Key", "LastModified", "ETag", ...}) through the stages."""
+    ctx.cache_stats = start_run_stats()
+    batcher_cm = WriteBehindBatcher(settings.db_batch_size, settings.db_flush_interval) if ctx.persist else contextlib.nullcontext()
+    async with batcher_cm as batcher:
+        ctx.batcher = batcher
+        stages = _stages()
+        queues = [asyncio.Queue(maxsize=settings.queue_size) for _ in range(len(stages) + 1)]
+        tasks = [asyncio.create_task(_produce(pages, ctx, queues[0]))]
+        for i, (name, fn, workers) in enumerate(stages):
+            tasks.append(asyncio.create_task(_run_stage(name, fn, workers, ctx, queues[i], queues[i + 1])))
+        try:
+            while True:
+                item = await _next_output(queues[-1], tasks)
+                if item is _DONE:
+                    break
+                ctx.record(item.result)
+                yield item.result
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    sem = asyncio.Semaphore(settings.concurrency)
-    tasks = [asyncio.create_task(_process_object(obj, rule_id, store_id, sem)) for obj in objs_recent]
-    results = await asyncio.gather(*tasks)
-    return {"prefix": prefix, "rule_id": rule_id, "processed": len(results), "results": results}
+async def run_pipeline_for_prefix(prefix: str, rule_ids: List[str] | str, store_id: str = None, incremental: bool = False, skip_download: bool = None):
+    """
+    Audit every recent object under prefix against one or more rules in a single pass:
+    each object is downloaded, hashed and sent to each Rekognition API only once.
+    incremental: skip objects whose current ETag was already audited under a rule, so
+    re-runs (and interrupted runs started again) only pay for new or changed photos.
+    skip_download: take the pHash from earlier runs by ETag and call Rekognition with
+    S3Object, downloading only objects whose ETag has no stored pHash (default: settings).
+    """
+    if isinstance(rule_ids, str):
+        rule_ids = [rule_ids]
+    ctx = RunContext(rule_ids, store_id, incremental=incremental)
+    if skip_download is not None:
+        ctx.skip_download = skip_download
+    results = [r async for r in stream_pipeline_for_prefix(prefix, ctx)]
+    return {"prefix": prefix, "run_id": ctx.run_id, "rule_id": rule_ids[0] if len(rule_ids) == 1 else None, "rule_ids": rule_ids, "processed": len(results), "skipped": ctx.skipped, "downloads_skipped": ctx.downloads_skipped, "rekognition_cache": ctx.cache_stats.as_dict(), "stage_timings": ctx.stage_timings(), "results": results}
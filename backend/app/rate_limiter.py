@@ -0,0 +1,112 @@
+# rate_limiter.py
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict
+from botocore.exceptions import ClientError
+from config import settings
+from metrics import GaugeCallback, REKOGNITION_CALLS, REKOGNITION_ERRORS, REKOGNITION_THROTTLES
+
+THROTTLE_CODES = {"ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException"}
+RETRYABLE_CODES = THROTTLE_CODES | {"InternalServerError", "ServiceUnavailableException"}
+
+class AdaptiveLimiter:
+    """
+    Token bucket whose refill rate adapts AIMD-style: every success adds `increase / rate`
+    (about +`increase` TPS per second at full speed), every throttle multiplies the rate by
+    `decrease` (at most once per `cooldown` seconds, so one burst of 429s counts once).
+    """
+    def __init__(self, name: str, initial_rate: float, min_rate: float, max_rate: float,
+                 increase: float, decrease: float = 0.5, cooldown: float = 1.0):
+        self.name = name
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.burst = max(1.0, initial_rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = asyncio.Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.throttles = 0
+        self.errors = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        self.burst = max(1.0, self.rate)
+
+    def on_throttle(self):
+        self.throttles += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.burst = max(1.0, self.rate)
+            self._tokens = min(self._tokens, self.burst)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rate_tps": round(self.rate, 3), "in_flight": self.in_flight, "calls": self.calls,
+                "throttles": self.throttles, "errors": self.errors}
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+
+def get_limiter(api: str) -> AdaptiveLimiter:
+    """Process-wide limiter per Rekognition API, shared by every run and job."""
+    limiter = _limiters.get(api)
+    if limiter is None:
+        limiter = _limiters[api] = AdaptiveLimiter(
+            api, settings.rek_initial_tps, settings.rek_min_tps, settings.rek_max_tps, settings.rek_tps_increase)
+    return limiter
+
+def limiter_stats() -> Dict[str, Dict[str, Any]]:
+    return {api: l.stats() for api, l in _limiters.items()}
+
+GaugeCallback("rekognition_rate_tps", "Current adaptive request rate per Rekognition API.", ["api"],
+              lambda: {(api,): l.rate for api, l in _limiters.items()})
+GaugeCallback("rekognition_in_flight", "Rekognition calls currently in flight per API.", ["api"],
+              lambda: {(api,): l.in_flight for api, l in _limiters.items()})
+
+async def limited_call(api: str, call: Callable[[], Awaitable[dict]]) -> dict:
+    """
+    Run `call` under the API's limiter. Throttling feeds back into the rate and is
+    retried with jittered exponential backoff, up to `rek_max_retries` times.
+    """
+    limiter = get_limiter(api)
+    for attempt in range(settings.rek_max_retries + 1):
+        await limiter.acquire()
+        limiter.calls += 1
+        limiter.in_flight += 1
+        REKOGNITION_CALLS.inc(api=api)
+        try:
+            resp = await call()
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in THROTTLE_CODES:
+                limiter.on_throttle()
+                REKOGNITION_THROTTLES.inc(api=api)
+            else:
+                limiter.errors += 1
+                REKOGNITION_ERRORS.inc(api=api)
+            if code not in RETRYABLE_CODES or attempt == settings.rek_max_retries:
+                raise
+            await asyncio.sleep(random.uniform(0, min(20.0, 0.2 * 2 ** attempt)))
+            continue
+        finally:
+            limiter.in_flight -= 1
+        limiter.on_success()
+        return resp
@@ -0,0 +1,154 @@
+# rek_cache.py
+import asyncio
+import contextvars
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+from config import settings
+from metrics import CACHE_LOOKUPS
+
+# -------------------------
+# Per-run hit/miss counters
+# -------------------------
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else None}
+
+_run_stats: contextvars.ContextVar[Optional[CacheStats]] = contextvars.ContextVar("rek_cache_stats", default=None)
+
+def start_run_stats() -> CacheStats:
+    """Attach fresh counters to the current context; tasks created afterwards share them."""
+    stats = CacheStats()
+    _run_stats.set(stats)
+    return stats
+
+def _record(api: str, hit: bool):
+    CACHE_LOOKUPS.inc(api=api, result="hit" if hit else "miss")
+    stats = _run_stats.get()
+    if stats is not None:
+        if hit: stats.hits += 1
+        else: stats.misses += 1
+
+# -------------------------
+# Keys
+# -------------------------
+def content_id_for_bytes(image_bytes: bytes) -> str:
+    return content_id_for_digest(hashlib.sha256(image_bytes).hexdigest())
+
+def content_id_for_digest(sha256_hex: str) -> str:
+    return "sha256:" + sha256_hex
+
+def content_id_for_etag(etag: str) -> str:
+    return "etag:" + etag.strip('"')
+
+def make_key(api: str, content_id: str, params: Dict[str, Any]) -> str:
+    raw = f"{api}|{content_id}|{json.dumps(params, sort_keys=True, default=str)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# -------------------------
+# SQLite store
+# -------------------------
+class RekognitionCache:
+    """
+    Content-addressed Rekognition response store in a local SQLite file.
+    Keyed by (API name, image content id, call params); the content id is the sha256 of
+    the bytes or the S3 ETag. Entries expire after `ttl_seconds`, and least recently used
+    entries are evicted once stored responses exceed `max_bytes`.
+    """
+    _PURGE_EVERY = 200  # puts between TTL/size sweeps
+
+    def __init__(self, path: str, ttl_seconds: int, max_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rek_cache ("
+            " key TEXT PRIMARY KEY, api TEXT NOT NULL, response TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_rek_cache_accessed ON rek_cache (accessed_at)")
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM rek_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM rek_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE rek_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, api: str, response: dict):
+        payload = json.dumps(response, default=str)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rek_cache (key, api, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, api, payload, len(payload), now, now),
+            )
+            self._puts += 1
+            if self._puts % self._PURGE_EVERY == 0:
+                self._purge(now)
+
+    def _purge(self, now: float):
+        self._conn.execute("DELETE FROM rek_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM rek_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # evict least recently used entries down to 90% of the budget
+        excess = total - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM rek_cache ORDER BY accessed_at"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.executemany("DELETE FROM rek_cache WHERE key = ?", victims)
+
+_cache: Optional[RekognitionCache] = None
+_cache_init_lock = threading.Lock()
+
+def get_cache() -> Optional[RekognitionCache]:
+    global _cache
+    if not settings.rek_cache_enabled:
+        return None
+    if _cache is None:
+        with _cache_init_lock:
+            if _cache is None:
+                _cache = RekognitionCache(settings.rek_cache_path, settings.rek_cache_ttl_seconds, settings.rek_cache_max_mb * 1024 * 1024)
+    return _cache
+
+async def cached_call(api: str, content_id: Optional[str], params: Dict[str, Any], call: Callable[[], Awaitable[dict]]) -> dict:
+    """
+    Return the cached response for (api, content_id, params) or await `call()` and cache
+    its result. Without a content id the call is not cached.
+    """
+    cache = get_cache()
+    if cache is None or content_id is None:
+        return await call()
+    key = make_key(api, content_id, params)
+    hit = await asyncio.to_thread(cache.get, key)
+    if hit is not None:
+        _record(api, True)
+        return hit
+    _record(api, False)
+    resp = await call()
+    resp = {k: v for k, v in resp.items() if k != "ResponseMetadata"}
+    await asyncio.to_thread(cache.put, key, api, resp)
+    return resp
@@ -0,0 +1,243 @@
+# rule_engine.py
+import importlib
+import logging
+import re
+import threading
+from functools import cached_property
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type
+from config import settings
+from rules_loader import RULES_PATH, load_rules
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LABEL_CONFIDENCE = 70
+DEFAULT_MAX_LABELS = 20
+
+def normalize_text(s: str) -> str:
+    """Case- and whitespace-insensitive form used for text and label comparisons."""
+    return re.sub(r"\s+", " ", (s or "")).strip().casefold()
+
+# -------------------------
+# Rekognition responses, normalized once per image
+# -------------------------
+class Detections:
+    """Views over one image's Rekognition responses, computed lazily and shared by all rules."""
+    def __init__(self, responses: Dict[str, dict]):
+        self.responses = responses
+
+    @cached_property
+    def face_count(self) -> int:
+        return len(self.responses["faces"].get("FaceDetails", []))
+
+    @cached_property
+    def text(self) -> str:
+        """All detected text, normalized and space-joined (matches may span detections)."""
+        return " ".join(normalize_text(t.get("DetectedText", "")) for t in self.responses["text"].get("TextDetections", []))
+
+    @cached_property
+    def label_confidence(self) -> Dict[str, float]:
+        """Normalized label name -> highest confidence it was detected with."""
+        out: Dict[str, float] = {}
+        for l in self.responses["labels"].get("Labels", []):
+            name = normalize_text(l.get("Name", ""))
+            out[name] = max(out.get(name, 0.0), l.get("Confidence", 100.0))
+        return out
+
+    def labels_at(self, min_confidence: float) -> set:
+        return {n for n, c in self.label_confidence.items() if c >= min_confidence}
+
+    def summary(self) -> dict:
+        """Compact extract stored on the images row (images.rekognition_summary)."""
+        out = {}
+        if "labels" in self.responses:
+            out["labels"] = [{"name": l.get("Name"), "confidence": round(l.get("Confidence", 0.0), 1)}
+                             for l in self.responses["labels"].get("Labels", [])]
+        if "text" in self.responses:
+            detections = self.responses["text"].get("TextDetections", [])
+            words = [t.get("DetectedText") for t in detections if t.get("Type") == "WORD"]
+            out["text"] = words or [t.get("DetectedText") for t in detections]
+        if "faces" in self.responses:
+            out["face_count"] = self.face_count
+        return out
+
+# -------------------------
+# Rule types (plugin registry)
+# -------------------------
+RULE_TYPES: Dict[str, Type["CompiledRule"]] = {}
+
+def register_rule_type(*names: str) -> Callable[[type], type]:
+    """Class decorator registering a CompiledRule subclass for one or more visual_audit_types."""
+    def deco(cls):
+        for name in names:
+            RULE_TYPES[name] = cls
+        return cls
+    return deco
+
+class CompiledRule:
+    """
+    A rule from rules.json, validated and preprocessed once. Subclasses set `api`
+    (the Rekognition API they are evaluated from: "faces", "text" or "labels"),
+    may widen the call through call_params(), and implement evaluate().
+    """
+    api: Optional[str] = None
+
+    def __init__(self, rule: dict):
+        self.id = rule["id"]
+        self.type = rule.get("visual_audit_type")
+        self.rule = rule
+
+    def call_params(self) -> dict:
+        return {}
+
+    def evaluate(self, det: Detections) -> Tuple[str, Optional[str]]:
+        return "REVIEW", f"unsupported_rule_type_{self.type}"
+
+@register_rule_type("FaceCount")
+class FaceCountRule(CompiledRule):
+    api = "faces"
+
+    def __init__(self, rule: dict):
+        super().__init__(rule)
+        self.min_faces = int(rule.get("min_faces", 1))
+
+    def evaluate(self, det):
+        if det.face_count >= self.min_faces:
+            return "PASS", None
+        return "FAIL", f"face_count_{det.face_count}_lt_{self.min_faces}"
+
+@register_rule_type("TextMatch", "TextCheck")
+class TextMatchRule(CompiledRule):
+    api = "text"
+
+    def __init__(self, rule: dict):
+        super().__init__(rule)
+        self.expected = rule.get("expected_text", rule.get("text_required", ""))
+        self.pattern = normalize_text(self.expected)
+
+    def evaluate(self, det):
+        if self.pattern in det.text:
+            return "PASS", None
+        return "FAIL", f"text_not_found_{self.expected.upper()}"
+
+class _LabelRule(CompiledRule):
+    api = "labels"
+    default_max_labels = DEFAULT_MAX_LABELS
+
+    def __init__(self, rule: dict):
+        super().__init__(rule)
+        self.min_confidence = float(rule.get("min_confidence", DEFAULT_LABEL_CONFIDENCE))
+        self.max_labels = int(rule.get("max_labels", self.default_max_labels))
+
+    def call_params(self):
+        return {"max_labels": self.max_labels, "min_confidence": self.min_confidence}
+
+@register_rule_type("LabelCheck", "ObjectDetection")
+class LabelCheckRule(_LabelRule):
+    def __init__(self, rule: dict):
+        super().__init__(rule)
+        expected = rule.get("expected_labels") or ([rule["object_required"]] if rule.get("object_required") else [])
+        self.expected = frozenset(normalize_text(e) for e in expected)
+
+    def evaluate(self, det):
+        if self.expected <= det.labels_at(self.min_confidence):
+            return "PASS", None
+        return "FAIL", "labels_missing"
+
+@register_rule_type("PhotoPresence")
+class PhotoPresenceRule(_LabelRule):
+    """Something recognisable is in the photo and it is upright (see visual_audit.run_photo_presence)."""
+    default_max_labels = 5
+
+    def evaluate(self, det):
+        if not det.labels_at(self.min_confidence):
+            return "FAIL", "no_content_detected"
+        orientation = det.responses["labels"].get("OrientationCorrection") or "UP"
+        if orientation not in ("UP", "ROTATE_0"):
+            return "FAIL", f"orientation_{orientation}"
+        return "PASS", None
+
+def compile_rule(rule: dict) -> CompiledRule:
+    return RULE_TYPES.get(rule.get("visual_audit_type"), CompiledRule)(rule)
+
+# -------------------------
+# Compiled rule sets with hot reload
+# -------------------------
+class RuleSet:
+    """Immutable snapshot of rules.json: raw rules plus their compiled evaluators."""
+    def __init__(self, raw: Dict[str, dict], version: tuple = None):
+        self.raw = raw
+        self.version = version
+        self.compiled: Dict[str, CompiledRule] = {}
+        for rid, r in raw.items():
+            try:
+                self.compiled[rid] = compile_rule(r)
+            except (TypeError, ValueError, KeyError) as e:
+                logger.warning("rule %s could not be compiled: %s", rid, e)
+
+    def __contains__(self, rule_id: str):
+        return rule_id in self.compiled
+
+    def get(self, rule_id: str) -> Optional[CompiledRule]:
+        return self.compiled.get(rule_id)
+
+    def plan_calls(self, rule_ids: Iterable[str]) -> Dict[str, dict]:
+        """
+        Group rules by the Rekognition API they need so each API is called at most once
+        per image. detect_labels is requested at the lowest confidence (and highest
+        label count) any rule needs; each rule re-applies its own threshold afterwards.
+        """
+        calls: Dict[str, dict] = {}
+        for rid in rule_ids:
+            rule = self.compiled.get(rid)
+            if rule is None or rule.api is None:
+                continue
+            p = calls.setdefault(rule.api, {})
+            for k, v in rule.call_params().items():
+                p[k] = min(p.get(k, v), v) if k == "min_confidence" else max(p.get(k, v), v)
+        return calls
+
+class RuleEngine:
+    """
+    Serves the current RuleSet for a rules file. The file is re-read and recompiled only
+    when its mtime/size change; the new RuleSet replaces the old one in a single
+    assignment, so a run that took a snapshot keeps evaluating against it. A file that
+    fails to parse leaves the previous rules in place.
+    """
+    def __init__(self, path: Path = RULES_PATH):
+        self.path = Path(path)
+        self._current = RuleSet({})
+        self._seen: Optional[tuple] = None  # last file version tried, valid or not
+        self._lock = threading.Lock()
+
+    def _version(self) -> Optional[tuple]:
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def current(self) -> RuleSet:
+        version = self._version()
+        if version == self._seen:
+            return self._current
+        with self._lock:
+            if version != self._seen:
+                self._seen = version
+                try:
+                    self._current = RuleSet(load_rules(self.path), version)
+                except ValueError as e:  # json.JSONDecodeError
+                    logger.error("keeping previous rules; %s is invalid: %s", self.path, e)
+        return self._current
+
+def load_plugins(modules: List[str]):
+    """Import modules that register extra rule types with @register_rule_type."""
+    for name in modules:
+        importlib.import_module(name)
+
+load_plugins([m.strip() for m in settings.rule_plugins.split(",") if m.strip()])
+
+rule_engine = RuleEngine()
+
+def get_rules() -> RuleSet:
+    return rule_engine.current()
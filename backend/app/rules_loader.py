@@ -15,15 +15,37 @@ from pathlib import Path
 
 RULES_PATH = Path(__file__).parent / "rules.json"
 
-def load_rules():
+def load_rules(path=RULES_PATH):
     """
     Load rules.json and return a dict keyed by rule id.
     Expected rules.json: [ { "id": "rule_x", ... }, ... ]
+    For compiled, cached rules use rule_engine.get_rules().
     """
-    if not RULES_PATH.exists():
+    if not path.exists():
         return {}
-    with open(RULES_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         rules_list = json.load(f)
     # convert to dict for fast lookup
     rules = {r["id"]: r for r in rules_list if "id" in r}
     return rules
+
+def select_rules(rules, rule_ids=None, group=None, section=None):
+    """
+    Pick rule ids to audit: the explicit rule_ids plus every rule whose
+    "group"/"section" match (case-insensitive). Unknown ids raise KeyError.
+    """
+    selected = []
+    for rid in rule_ids or []:
+        if rid not in rules:
+            raise KeyError(rid)
+        if rid not in selected:
+            selected.append(rid)
+    if group or section:
+        for rid, r in rules.items():
+            if group and (r.get("group") or "").lower() != group.lower():
+                continue
+            if section and (r.get("section") or "").lower() != section.lower():
+                continue
+            if rid not in selected:
+                selected.append(rid)
+    return selected
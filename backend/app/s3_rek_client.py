@@ -1,20 +1,60 @@
 # s3_rek_client.py
-import boto3
-from botocore.config import Config
+import aioboto3
+from aiobotocore.config import AioConfig
 import asyncio
-from typing import List, Dict, Any
-from io import BytesIO
+from contextlib import AsyncExitStack
+from typing import List, Dict, Any, AsyncIterator
 from config import settings
-
-# Create boto3 clients (synchronous)
-_s3 = boto3.client("s3", region_name=settings.aws_region, config=Config(signature_version='s3v4'))
-_rek = boto3.client("rekognition", region_name=settings.aws_region, config=Config(retries={'max_attempts': 3}))
+from rek_cache import cached_call, content_id_for_bytes, content_id_for_etag
+from rate_limiter import limited_call
 
 # -------------------------
-# Helper to run blocking boto3 calls in thread
+# Shared async clients (aioboto3)
 # -------------------------
-async def _to_thread(func, *args, **kwargs):
-    return await asyncio.to_thread(func, *args, **kwargs)
+# One S3 and one Rekognition client per process, each with its own HTTP connection
+# pool (aws_max_pool_connections) and keep-alive, so in-flight calls don't hold threads.
+# Rekognition calls get a single SDK attempt (total_max_attempts=1, no hidden retry); retries are
+# left to rate_limiter.limited_call so every throttle adjusts the rate.
+_session = aioboto3.Session(region_name=settings.aws_region)
+_stack: AsyncExitStack | None = None
+_clients: Dict[str, Any] = {}
+_clients_lock = asyncio.Lock()
+
+def _client_config(**kwargs) -> AioConfig:
+    return AioConfig(
+        max_pool_connections=settings.aws_max_pool_connections,
+        connect_timeout=settings.aws_connect_timeout,
+        read_timeout=settings.aws_read_timeout,
+        tcp_keepalive=True,
+        connector_args={"keepalive_timeout": settings.aws_keepalive_timeout},
+        **kwargs,
+    )
+
+async def start_clients():
+    """Open the shared clients (called on app startup; otherwise opened on first use)."""
+    global _stack
+    async with _clients_lock:
+        if _stack is not None:
+            return
+        stack = AsyncExitStack()
+        _clients["s3"] = await stack.enter_async_context(_session.client("s3", endpoint_url=settings.s3_endpoint_url, config=_client_config(signature_version='s3v4')))
+        _clients["rekognition"] = await stack.enter_async_context(_session.client("rekognition", config=_client_config(retries={'total_max_attempts': 1})))
+        if settings.sqs_queue_url:
+            _clients["sqs"] = await stack.enter_async_context(_session.client("sqs", endpoint_url=settings.sqs_endpoint_url, config=_client_config()))
+        _stack = stack
+
+async def close_clients():
+    global _stack
+    async with _clients_lock:
+        if _stack is not None:
+            await _stack.aclose()
+            _stack = None
+            _clients.clear()
+
+async def _client(name: str):
+    if _stack is None:
+        await start_clients()
+    return _clients[name]
 
 # -------------------------
 # S3 helpers (async)
@@ -22,77 +62,115 @@ async def _to_thread(func, *args, **kwargs):
 async def list_objects(prefix: str, max_keys: int = 1000) -> List[Dict[str, Any]]:
     """
     List objects under a prefix in the configured S3 bucket.
-    Returns list of dicts with Key and LastModified.
+    Returns list of dicts with Key, LastModified, Size and ETag (unquoted).
     """
-    bucket = settings.s3_bucket
-
-    def _list():
-        paginator = _s3.get_paginator("list_objects_v2")
-        page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
-        objs = []
-        for page in page_iterator:
-            for obj in page.get("Contents", []):
-                objs.append({"Key": obj["Key"], "LastModified": obj["LastModified"], "Size": obj.get("Size")})
-        return objs
+    objs = []
+    async for page in iter_object_pages(prefix, max_keys):
+        objs.extend(page)
+    return objs
 
-    return await _to_thread(_list)
+async def iter_object_pages(prefix: str, page_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Yield objects under a prefix one list_objects_v2 page at a time, so callers can
+    start processing before the whole prefix has been listed.
+    """
+    s3 = await _client("s3")
+    paginator = s3.get_paginator("list_objects_v2")
+    async for page in paginator.paginate(Bucket=settings.s3_bucket, Prefix=prefix, PaginationConfig={"PageSize": page_size}):
+        yield [{"Key": obj["Key"], "LastModified": obj["LastModified"], "Size": obj.get("Size"), "ETag": obj.get("ETag", "").strip('"')} for obj in page.get("Contents", [])]
 
 async def get_object_bytes(key: str) -> bytes:
     """Download object content as bytes."""
-    bucket = settings.s3_bucket
+    s3 = await _client("s3")
+    resp = await s3.get_object(Bucket=settings.s3_bucket, Key=key)
+    async with resp["Body"] as body:
+        return await body.read()
 
-    def _get():
-        resp = _s3.get_object(Bucket=bucket, Key=key)
-        return resp["Body"].read()
-
-    return await _to_thread(_get)
+# -------------------------
+# SQS helpers (ingest.py)
+# -------------------------
+async def receive_messages(queue_url: str, max_messages: int = 10, wait_seconds: int = 20, visibility_timeout: int = None) -> List[Dict[str, Any]]:
+    """Long-poll up to max_messages (<= 10) messages; returns [] when the wait times out."""
+    sqs = await _client("sqs")
+    kwargs = {"VisibilityTimeout": visibility_timeout} if visibility_timeout else {}
+    resp = await sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=max_messages, WaitTimeSeconds=wait_seconds, **kwargs)
+    return resp.get("Messages", [])
+
+async def delete_messages(queue_url: str, receipt_handles: List[str]) -> List[str]:
+    """Delete in batches of 10 (one request each); returns the receipt handles that failed."""
+    sqs = await _client("sqs")
+    failed = []
+    for i in range(0, len(receipt_handles), 10):
+        chunk = receipt_handles[i:i + 10]
+        resp = await sqs.delete_message_batch(QueueUrl=queue_url, Entries=[{"Id": str(n), "ReceiptHandle": h} for n, h in enumerate(chunk)])
+        failed.extend(chunk[int(f["Id"])] for f in resp.get("Failed", []))
+    return failed
+
+async def extend_visibility(queue_url: str, receipt_handles: List[str], timeout: int) -> List[str]:
+    """Reset the visibility timeout of in-flight messages in batches of 10; returns handles that failed."""
+    sqs = await _client("sqs")
+    failed = []
+    for i in range(0, len(receipt_handles), 10):
+        chunk = receipt_handles[i:i + 10]
+        resp = await sqs.change_message_visibility_batch(
+            QueueUrl=queue_url, Entries=[{"Id": str(n), "ReceiptHandle": h, "VisibilityTimeout": timeout} for n, h in enumerate(chunk)])
+        failed.extend(chunk[int(f["Id"])] for f in resp.get("Failed", []))
+    return failed
 
 # -------------------------
-# Rekognition wrappers (async)
+# Rekognition wrappers (async, cached by image content - see rek_cache.py)
 # -------------------------
-async def detect_faces_bytes(image_bytes: bytes, attributes: list = None) -> dict:
+async def detect_faces_bytes(image_bytes: bytes, attributes: list = None, content_id: str = None) -> dict:
     """
     Returns Rekognition detect_faces response for given image bytes.
+    content_id: precomputed rek_cache content id; defaults to the sha256 of image_bytes.
     """
     if attributes is None:
         attributes = ['DEFAULT']
 
-    def _call():
-        return _rek.detect_faces(Image={'Bytes': image_bytes}, Attributes=attributes)
+    async def _call():
+        rek = await _client("rekognition")
+        return await limited_call("DetectFaces", lambda: rek.detect_faces(Image={'Bytes': image_bytes}, Attributes=attributes))
 
-    return await _to_thread(_call)
+    return await cached_call("DetectFaces", content_id or content_id_for_bytes(image_bytes), {"Attributes": attributes}, _call)
 
-async def detect_labels_bytes(image_bytes: bytes, max_labels: int = 20, min_confidence: int = 70) -> dict:
+async def detect_labels_bytes(image_bytes: bytes, max_labels: int = 20, min_confidence: int = 70, content_id: str = None) -> dict:
     """
     Returns Rekognition detect_labels response for given image bytes.
     """
-    def _call():
-        return _rek.detect_labels(Image={'Bytes': image_bytes}, MaxLabels=max_labels, MinConfidence=min_confidence)
+    async def _call():
+        rek = await _client("rekognition")
+        return await limited_call("DetectLabels", lambda: rek.detect_labels(Image={'Bytes': image_bytes}, MaxLabels=max_labels, MinConfidence=min_confidence))
 
-    return await _to_thread(_call)
+    return await cached_call("DetectLabels", content_id or content_id_for_bytes(image_bytes), {"MaxLabels": max_labels, "MinConfidence": min_confidence}, _call)
 
-async def detect_text_bytes(image_bytes: bytes) -> dict:
+async def detect_text_bytes(image_bytes: bytes, content_id: str = None) -> dict:
     """
     Returns Rekognition detect_text response for given image bytes.
     """
-    def _call():
-        return _rek.detect_text(Image={'Bytes': image_bytes})
+    async def _call():
+        rek = await _client("rekognition")
+        return await limited_call("DetectText", lambda: rek.detect_text(Image={'Bytes': image_bytes}))
 
-    return await _to_thread(_call)
+    return await cached_call("DetectText", content_id or content_id_for_bytes(image_bytes), {}, _call)
 
-async def detect_faces_s3(bucket: str, key: str, attributes: list = None) -> dict:
+# The *_s3 variants are only cached when the caller passes the object's ETag.
+async def detect_faces_s3(bucket: str, key: str, attributes: list = None, etag: str = None) -> dict:
     if attributes is None:
         attributes = ['DEFAULT']
-    def _call():
-        return _rek.detect_faces(Image={'S3Object': {'Bucket': bucket, 'Name': key}}, Attributes=attributes)
-    return await _to_thread(_call)
-
-async def detect_labels_s3(bucket: str, key: str, max_labels: int = 20, min_confidence: int = 70) -> dict:
-    def _call():
-        return _rek.detect_labels(Image={'S3Object': {'Bucket': bucket, 'Name': key}}, MaxLabels=max_labels, MinConfidence=min_confidence)
-    return await _to_thread(_call)
-
-async def detect_text_s3(bucket: str, key: str) -> dict:
-    def _call():
-        return _rek.detect_text(Image={'S3Object': {'Bucket': bucket, 'Name': key}})
-    return await _to_thread(_call)
+    async def _call():
+        rek = await _client("rekognition")
+        return await limited_call("DetectFaces", lambda: rek.detect_faces(Image={'S3Object': {'Bucket': bucket, 'Name': key}}, Attributes=attributes))
+    return await cached_call("DetectFaces", content_id_for_etag(etag) if etag else None, {"Attributes": attributes}, _call)
+
+async def detect_labels_s3(bucket: str, key: str, max_labels: int = 20, min_confidence: int = 70, etag: str = None) -> dict:
+    async def _call():
+        rek = await _client("rekognition")
+        return await limited_call("DetectLabels", lambda: rek.detect_labels(Image={'S3Object': {'Bucket': bucket, 'Name': key}}, MaxLabels=max_labels, MinConfidence=min_confidence))
+    return await cached_call("DetectLabels", content_id_for_etag(etag) if etag else None, {"MaxLabels": max_labels, "MinConfidence": min_confidence}, _call)
+
+async def detect_text_s3(bucket: str, key: str, etag: str = None) -> dict:
+    async def _call():
+        rek = await _client("rekognition")
+        return await limited_call("DetectText", lambda: rek.detect_text(Image={'S3Object': {'Bucket': bucket, 'Name': key}}))
+    return await cached_call("DetectText", content_id_for_etag(etag) if etag else None, {}, _call)
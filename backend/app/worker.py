@@ -0,0 +1,159 @@
+# worker.py
+"""
+Audit worker for distributed jobs (POST /run_audit with "distributed": true).
+
+The API process lists the job's prefix into audit_work_items; every worker process
+claims batches of items with SELECT ... FOR UPDATE SKIP LOCKED, runs them through
+pipeline._process_object and marks them DONE once their audits are flushed. Claims are
+leases: a worker extends them while it works, and items of a worker that crashed are
+claimed again after work_lease_seconds (up to work_max_attempts times).
+
+    python worker.py                      # one worker; start as many as Postgres/Rekognition allow
+    python worker.py --batch-size 64 --worker-id host-a-1
+
+Delivery is at-least-once: an item whose lease expired mid-flight may be audited twice.
+For near-duplicate detection across workers use dedup_backend="database"; the "memory"
+backend only sees images persisted before a worker first touched the prefix.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import uuid
+from collections import OrderedDict
+from datetime import timezone
+from typing import Dict, List, Optional
+from config import settings
+from crud import (claim_work_items, complete_work_items, extend_work_leases, fail_work_items, finish_drained_jobs,
+                  get_job, release_work_items)
+from database import create_db_and_tables, engine
+from image_utils import init_process_pool, shutdown_process_pool
+from persistence import WriteBehindBatcher
+from pipeline import RunContext, _process_object
+from rule_engine import get_rules
+from s3_rek_client import close_clients, start_clients
+
+logger = logging.getLogger("worker")
+
+MAX_CONTEXTS = 8  # run contexts (compiled rules, pHash indexes) kept for recently seen jobs
+
+class Worker:
+    def __init__(self, worker_id: str, batch_size: int, lease_seconds: float, poll_interval: float, max_attempts: int):
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.stopping = asyncio.Event()
+        self._contexts: "OrderedDict[str, Optional[RunContext]]" = OrderedDict()
+
+    async def _context(self, job_id: str) -> Optional[RunContext]:
+        """One RunContext per job (run_id = job id), so audits of all workers share the job's run."""
+        if job_id in self._contexts:
+            self._contexts.move_to_end(job_id)
+            return self._contexts[job_id]
+        job = await get_job(job_id)
+        ctx = RunContext(job.rule_ids, job.store_id, run_id=job.id) if job is not None else None
+        self._contexts[job_id] = ctx
+        while len(self._contexts) > MAX_CONTEXTS:
+            self._contexts.popitem(last=False)
+        return ctx
+
+    async def run(self):
+        logger.info("worker %s started (batch %d, lease %.0fs)", self.worker_id, self.batch_size, self.lease_seconds)
+        while not self.stopping.is_set():
+            try:
+                items = await claim_work_items(self.worker_id, self.batch_size, self.lease_seconds, self.max_attempts)
+                if items:
+                    await self._process_batch(items)
+                    continue
+            except Exception:
+                # e.g. the database is briefly unreachable; unfinished claims are retried once their lease runs out
+                logger.exception("worker %s: batch failed, retrying in %.1fs", self.worker_id, self.poll_interval)
+            await self._idle()
+        logger.info("worker %s stopped", self.worker_id)
+
+    async def _idle(self):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _keep_leases(self, ids: List[int]):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                held = await extend_work_leases(ids, self.worker_id, self.lease_seconds)
+            except Exception:
+                logger.exception("worker %s: extending %d leases failed", self.worker_id, len(ids))
+                continue
+            if held < len(ids):
+                logger.warning("worker %s lost %d of %d leases", self.worker_id, len(ids) - held, len(ids))
+
+    async def _process_batch(self, items):
+        contexts = {job_id: await self._context(job_id) for job_id in {i.job_id for i in items}}
+        orphaned = [i.id for i in items if contexts[i.job_id] is None]
+        await fail_work_items(orphaned, "job not found")
+        items = [i for i in items if contexts[i.job_id] is not None]
+
+        results: Dict[int, str] = {}
+        errors: Dict[int, str] = {}
+        keeper = asyncio.create_task(self._keep_leases([i.id for i in items]))
+        try:
+            # items are marked DONE only after the batcher has flushed their audits
+            async with WriteBehindBatcher(settings.db_batch_size, settings.db_flush_interval) as batcher:
+                for ctx in contexts.values():
+                    if ctx is not None:
+                        ctx.batcher = batcher
+
+                async def run_item(item):
+                    ctx = contexts[item.job_id]
+                    obj = {"Key": item.s3_key, "ETag": item.etag, "Size": item.size,
+                           "LastModified": item.last_modified.replace(tzinfo=timezone.utc) if item.last_modified else None}
+                    try:
+                        result = await _process_object(obj, ctx, item.rule_ids)
+                    except Exception as e:
+                        logger.exception("work item %s (%s) failed", item.id, item.s3_key)
+                        errors[item.id] = str(e)
+                        return
+                    ctx.record(result)
+                    results[item.id] = result["status"]
+
+                await asyncio.gather(*(run_item(i) for i in items))
+        finally:
+            keeper.cancel()
+            await asyncio.gather(keeper, return_exceptions=True)
+        await complete_work_items(self.worker_id, results)
+        await release_work_items(self.worker_id, errors)
+        for job_id in await finish_drained_jobs(list(contexts)):
+            logger.info("job %s done", job_id)
+            self._contexts.pop(job_id, None)
+
+async def main(args):
+    await create_db_and_tables()
+    get_rules()
+    await start_clients()
+    init_process_pool(settings.image_workers)
+    worker = Worker(args.worker_id, args.batch_size, args.lease_seconds, settings.work_poll_interval, settings.work_max_attempts)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.stopping.set)  # finish the current batch, then exit
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await worker.run()
+    finally:
+        shutdown_process_pool()
+        await close_clients()
+        await engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process work items of distributed audit jobs.")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+    parser.add_argument("--batch-size", type=int, default=settings.work_batch_size, help="items claimed (and audited concurrently) at a time")
+    parser.add_argument("--lease-seconds", type=float, default=settings.work_lease_seconds)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,48 @@
+# fake_rekognition.py
+import asyncio
+import hashlib
+import random
+from botocore.exceptions import ClientError
+
+class FakeRekognition:
+    """
+    Stand-in for the aioboto3 Rekognition client used by s3_rek_client. Each call sleeps
+    for `latency` +/- `jitter` seconds, fails with ThrottlingException with probability
+    `throttle_rate`, and otherwise returns a response derived from the image (so repeated
+    runs over the same images give the same audit results).
+    """
+    def __init__(self, latency: float = 0.15, jitter: float = 0.05, throttle_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self.calls = 0
+        self.throttled = 0
+
+    async def _respond(self, op: str, image: dict) -> int:
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self._rng.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+        if self._rng.random() < self.throttle_rate:
+            self.throttled += 1
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, op)
+        if "Bytes" in image:
+            source = image["Bytes"][:4096]
+        else:
+            source = image["S3Object"]["Name"].encode()
+        return hashlib.sha256(source).digest()[0]
+
+    async def detect_faces(self, Image, Attributes=None):
+        seed = await self._respond("DetectFaces", Image)
+        return {"FaceDetails": [{"Confidence": 99.0} for _ in range(seed % 5)]}
+
+    async def detect_labels(self, Image, MaxLabels=20, MinConfidence=70):
+        seed = await self._respond("DetectLabels", Image)
+        labels = [{"Name": name, "Confidence": 60.0 + (seed * (i + 1)) % 40}
+                  for i, name in enumerate(["Person", "Shop", "Vi Logo", "Poster", "Shelf", "Indoors"])]
+        labels = [l for l in labels if l["Confidence"] >= MinConfidence]
+        return {"Labels": labels[:MaxLabels]}
+
+    async def detect_text(self, Image):
+        seed = await self._respond("DetectText", Image)
+        words = ["POP IN", "Vi", "OPEN", "SALE"]
+        return {"TextDetections": [{"DetectedText": w, "Type": "LINE", "Confidence": 95.0} for w in words[:seed % 5]]}
@@ -0,0 +1,32 @@
+import asyncio
+import os
+import signal
+from io import BytesIO
+from PIL import Image
+from app import image_utils
+from app.image_utils import init_process_pool, prepare_image, run_in_pool, shutdown_process_pool
+
+def _jpeg() -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (64, 48), (200, 40, 40)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+async def _kill_worker_then_prepare():
+    data = _jpeg()
+    digest, phash, _ = await run_in_pool(prepare_image, data, 16)
+    broken = image_utils._pool
+    os.kill(next(iter(broken._processes)), signal.SIGKILL)  # like an OOM kill
+    assert await run_in_pool(prepare_image, data, 16) == (digest, phash, None)
+    assert image_utils._pool is not broken
+    assert await run_in_pool(prepare_image, data, 16) == (digest, phash, None)
+
+def test_run_in_pool_recovers_from_killed_worker():
+    init_process_pool(2)
+    try:
+        asyncio.run(_kill_worker_then_prepare())
+    finally:
+        shutdown_process_pool()
+
+if __name__ == "__main__":
+    test_run_in_pool_recovers_from_killed_worker()
+    print("ok")
@@ -1,5 +1,5 @@
 import asyncio
-from app.s3_rek_client import list_objects
+from app.s3_rek_client import list_objects, close_clients
 from app.config import settings
 
 async def main():
@@ -8,6 +8,7 @@ async def main():
     print(f"Found {len(objects)} objects in S3 prefix '{prefix}'")
     for obj in objects[:5]:
         print(obj)
+    await close_clients()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,7 +1,81 @@
+import argparse
+import csv
+import errno
 import os
+import re
 import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-def sort_images_by_keyword(source_folder, keywords_to_folders):
+MISC_FOLDER = 'Miscellaneous'
+
+def _compile_matcher(keywords_to_folders):
+    """
+    One case-insensitive pattern for all keywords. The lookahead reports, at every position,
+    the first keyword (in dict order) that starts there, so taking the lowest index over all
+    positions gives the same winner as checking the keywords one by one in order.
+    """
+    keywords = list(keywords_to_folders)
+    pattern = re.compile("(?=" + "|".join(f"({re.escape(k)})" for k in keywords) + ")", re.IGNORECASE)
+
+    def match(filename):
+        best = None
+        for m in pattern.finditer(filename):
+            i = m.lastindex - 1  # keyword i is group i + 1
+            if best is None or i < best:
+                best = i
+                if best == 0:
+                    break
+        return None if best is None else keywords_to_folders[keywords[best]]
+
+    return match
+
+def _scan_files(source_folder, skip_dirs, recursive):
+    """
+    Yield (DirEntry) for files in source_folder (and subfolders if recursive), one scandir per folder.
+    Symlinks to files are yielded (the link itself is moved); symlinked folders are not entered.
+    """
+    stack = [source_folder]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and entry.path not in skip_dirs:
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+def _existing_paths(folders):
+    """Paths already present in the destination folders, one listing per folder (normcase: Windows is case-insensitive)."""
+    taken = set()
+    for folder in folders:
+        if os.path.isdir(folder):
+            with os.scandir(folder) as it:
+                taken.update(os.path.normcase(entry.path) for entry in it)
+    return taken
+
+def _unique_destination(folder, name, taken):
+    """folder/name, or folder/"stem (n).ext" if another planned move or an existing file (see _existing_paths) has that path."""
+    destination = os.path.join(folder, name)
+    stem, ext = os.path.splitext(name)
+    n = 2
+    while os.path.normcase(destination) in taken:
+        destination = os.path.join(folder, f"{stem} ({n}){ext}")
+        n += 1
+    taken.add(os.path.normcase(destination))
+    return destination
+
+def _move(source_path, destination_path):
+    # destination_path is free according to the listing taken when the moves were planned
+    try:
+        os.rename(source_path, destination_path)  # same filesystem: a metadata-only rename
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source_path, destination_path)
+
+def sort_images_by_keyword(source_folder, keywords_to_folders, dry_run=False, recursive=False,
+                           manifest_path=None, workers=16, verbose=False):
     """
     Sorts image files from a source folder into new folders based on keywords in their names.
 
@@ -9,62 +83,80 @@ def sort_images_by_keyword(source_folder, keywords_to_folders):
         source_folder (str): The path to the folder containing the images.
         keywords_to_folders (dict): A dictionary where keys are keywords to search for
                                     in filenames and values are the corresponding
-                                    folder names for those images.
+                                    folder names for those images. The first matching
+                                    keyword (in dict order) wins; matching is case-insensitive.
+        dry_run (bool): Only plan the moves and write them to the manifest.
+        recursive (bool): Also sort files in subfolders (destination folders are skipped).
+                          Files whose name is already taken in the destination folder are
+                          renamed to "name (2).ext", "name (3).ext", ...
+        manifest_path (str): CSV of planned/performed moves (source, destination, folder, status).
+                             Defaults to "sort_manifest.csv" in the working directory for dry runs.
+        workers (int): Threads performing the renames.
+        verbose (bool): Print every move instead of only the summary.
+
+    Returns:
+        dict: Number of files per destination folder, plus "errors" for failed moves.
     """
-    if not os.path.exists(source_folder):
+    if not os.path.isdir(source_folder):
         print(f"Error: The source folder '{source_folder}' does not exist.")
-        return
+        return {}
 
-    # Create a folder for images that don't match any keyword
-    misc_folder = os.path.join(source_folder, 'Miscellaneous')
-    if not os.path.exists(misc_folder):
-        os.makedirs(misc_folder)
-        print(f"Created folder: '{misc_folder}'")
+    match = _compile_matcher(keywords_to_folders)
+    destinations = {name: os.path.join(source_folder, name) for name in list(keywords_to_folders.values()) + [MISC_FOLDER]}
+    skip_dirs = set(destinations.values())
 
     print(f"Scanning folder: '{source_folder}'...")
+    plan = []
+    # destinations are unique before the threads start: same-named files from subfolders get " (n)"
+    taken = _existing_paths(skip_dirs)
+    for entry in _scan_files(source_folder, skip_dirs, recursive):
+        folder_name = match(entry.name) or MISC_FOLDER
+        plan.append((entry.path, _unique_destination(destinations[folder_name], entry.name, taken), folder_name))
+
+    counts = Counter(folder_name for _, _, folder_name in plan)
+    statuses = ["planned"] * len(plan)
+
+    if not dry_run:
+        for folder_name in counts:
+            os.makedirs(destinations[folder_name], exist_ok=True)
 
-    # Iterate through all files in the source folder
-    for filename in os.listdir(source_folder):
-        # Construct the full path to the file
-        source_path = os.path.join(source_folder, filename)
-
-        # Skip directories, we only want to process files
-        if os.path.isdir(source_path):
-            continue
-        
-        # Assume the file won't be sorted initially
-        sorted_flag = False
-
-        # Check the filename against the defined keywords
-        for keyword, folder_name in keywords_to_folders.items():
-            if keyword.lower() in filename.lower():
-                # Construct the full path for the destination folder
-                destination_folder = os.path.join(source_folder, folder_name)
-
-                # Create the destination folder if it doesn't exist
-                if not os.path.exists(destination_folder):
-                    os.makedirs(destination_folder)
-                    print(f"Created folder: '{destination_folder}'")
-
-                # Construct the full path for the destination file
-                destination_path = os.path.join(destination_folder, filename)
-
-                try:
-                    # Move the file to the new folder
-                    shutil.move(source_path, destination_path)
-                    print(f"Moved '{filename}' to '{folder_name}' folder.")
-                    sorted_flag = True
-                    break  # Exit the loop once a keyword is matched
-                except Exception as e:
-                    print(f"Error moving file {filename}: {e}")
-        
-        # If no keyword was matched, move the file to the 'Miscellaneous' folder
-        if not sorted_flag and os.path.isfile(source_path):
+        def move(i):
+            source_path, destination_path, folder_name = plan[i]
             try:
-                shutil.move(source_path, os.path.join(misc_folder, filename))
-                print(f"Moved '{filename}' to 'Miscellaneous' folder.")
+                _move(source_path, destination_path)
             except Exception as e:
-                print(f"Error moving file {filename} to Miscellaneous: {e}")
+                statuses[i] = f"error: {e}"
+                print(f"Error moving file {os.path.basename(source_path)} to {folder_name}: {e}")
+                return
+            statuses[i] = "moved"
+            if verbose:
+                print(f"Moved '{os.path.basename(source_path)}' to '{folder_name}' folder.")
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(move, range(len(plan))))
+        for (_, _, folder_name), status in zip(plan, statuses):
+            if status != "moved":
+                counts[folder_name] -= 1
+                counts["errors"] += 1
+
+    if manifest_path is None and dry_run:
+        manifest_path = "sort_manifest.csv"
+    if manifest_path:
+        with open(manifest_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["source", "destination", "folder", "status"])
+            writer.writerows((s, d, name, status) for (s, d, name), status in zip(plan, statuses))
+
+    verb = "Would move" if dry_run else "Moved"
+    print(f"\n{verb} {len(plan) - counts['errors']} of {len(plan)} files:")
+    for folder_name, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+        if folder_name != "errors" and n:
+            print(f"  {folder_name}: {n}")
+    if counts["errors"]:
+        print(f"  errors: {counts['errors']}")
+    if manifest_path:
+        print(f"Manifest written to '{manifest_path}'")
+    return {k: v for k, v in counts.items() if v}
 
 # --- Main execution part ---
 
@@ -91,6 +183,16 @@ if __name__ == "__main__":
         "washroom": "Washroom"
     }
 
+    parser = argparse.ArgumentParser(description="Sort image files into folders by keywords in their names.")
+    parser.add_argument("source", nargs="?", default=source_directory)
+    parser.add_argument("--dry-run", action="store_true", help="only write the manifest of planned moves")
+    parser.add_argument("--recursive", action="store_true", help="also sort files in subfolders")
+    parser.add_argument("--manifest", default=None, help="CSV manifest path (default for dry runs: sort_manifest.csv)")
+    parser.add_argument("--workers", type=int, default=16, help="threads performing the renames")
+    parser.add_argument("--verbose", action="store_true", help="print every move")
+    args = parser.parse_args()
+
     # Run the function with your specified settings
-    sort_images_by_keyword(source_directory, sorting_rules)
+    sort_images_by_keyword(args.source, sorting_rules, dry_run=args.dry_run, recursive=args.recursive,
+                           manifest_path=args.manifest, workers=args.workers, verbose=args.verbose)
     print("\nSorting process completed.")